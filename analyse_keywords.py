@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+'''
+count config.keywords_list in syllabi already downloaded by get_namelist.py
+
+Every .txt / .pdf under <root>/<semester>/ is read (pdf text through the
+crawler.extract cache, so only new pdfs run textract) and counted in
+parallel worker processes; one log.csv per semester is written, in the same
+format as get_namelist.py's: the keyword counts, then an error column that is
+empty unless the file had no text (its counts are left empty too). Courses
+keep the listing departments of get_namelist.py's log.csv when there is one.
+'''
+
+import argparse
+import csv
+import os
+import re
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import config as cfg
+from crawler.extract import CACHE_PATH, WORKERS, ExtractionError, read_text
+from crawler.keywords import KeywordMatcher
+
+# <semester>-<dept>-<no>-<name_zh>, see get_namelist.gen_file_name
+file_name_re = re.compile(r'^[^-]+-(?P<dept>[^-]+)-(?P<no>[^-]+)-(?P<name>.*)$')
+
+# written by get_namelist.py in every semester folder
+NAMELIST_LOG = 'log.csv'
+
+_matcher = None
+_cache_path = None
+
+
+def init_worker(ignore_case, cache_path):
+    global _matcher, _cache_path
+    _matcher = KeywordMatcher(cfg.keywords_list, ignore_case)
+    _cache_path = cache_path
+
+
+def analyse_file(path):
+    '''
+    returns (keyword counts, None), or (None, error) if no text
+    '''
+    try:
+        content = read_text(path, _cache_path)
+    except ExtractionError as e:
+        return None, e.message
+    except (OSError, UnicodeDecodeError) as e:
+        return None, str(e)
+    if path.endswith('.txt'):
+        content = content.replace('\n', '')
+    return _matcher.count(content), None
+
+
+def syllabus_files(folder):
+    for name in sorted(os.listdir(folder)):
+        if name.endswith(('.txt', '.pdf')):
+            yield name
+
+
+def listing_depts(folder):
+    '''
+    {file name: [(dept, name_zh)]} from get_namelist.py's log in folder
+
+    get_namelist.py logs a course under the department whose curriculum
+    listed it, once per listing, which the file name (the department of
+    the course number) does not tell.
+    '''
+    listed = {}
+    try:
+        with open(os.path.join(folder, NAMELIST_LOG), newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 4:
+                    continue
+                entries = listed.setdefault(row[3], [])
+                if (row[0], row[1]) not in entries:
+                    entries.append((row[0], row[1]))
+    except (OSError, UnicodeDecodeError, csv.Error):
+        pass
+    return listed
+
+
+def log_rows(fName, counts, error=None, listed=None):
+    '''
+    the file's rows, one per listing department; by the department of the
+    course number if get_namelist.py did not log the file
+    '''
+    entries = (listed or {}).get(fName)
+    if not entries:
+        match = file_name_re.match(os.path.splitext(fName)[0])
+        entries = [
+            (match.group('dept'), match.group('name')) if match else ('', '')
+        ]
+    if error is not None:
+        counts = [''] * len(cfg.keywords_list)
+    return [
+        [dept, name, '', fName] + counts + [error or '']
+        for dept, name in entries
+    ]
+
+
+def analyse_semester(executor, folder, output, window):
+    '''
+    writes folder/output, returns (files counted, [(file, error)])
+    '''
+    failures = []
+    done = 0
+    listed = listing_depts(folder)
+    fd, tmp_path = tempfile.mkstemp(dir=folder)
+    with os.fdopen(fd, 'w', newline='') as log_csv:
+        w = csv.writer(log_csv, delimiter=',')
+        # at most <window> files in flight, rows stay in file order
+        pending = deque()
+
+        def write_oldest():
+            fName, future = pending.popleft()
+            counts, error = future.result()
+            if error is not None:
+                failures.append((fName, error))
+            w.writerows(log_rows(fName, counts, error, listed))
+
+        for fName in syllabus_files(folder):
+            if len(pending) >= window:
+                write_oldest()
+            pending.append((fName, executor.submit(
+                analyse_file, os.path.join(folder, fName))))
+            done += 1
+        while pending:
+            write_oldest()
+    os.replace(tmp_path, os.path.join(folder, output))
+    return done, failures
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Count keywords in downloaded syllabi'
+    )
+    parser.add_argument(
+        'semesters',
+        help='semester folders to analyse, e.g. 105上 (default: all)',
+        nargs='*'
+    )
+    parser.add_argument(
+        '--root',
+        help='where get_namelist.py downloaded to',
+        default='./syllabus_download'
+    )
+    parser.add_argument(
+        '--output',
+        help='csv file written in every semester folder',
+        default='log.csv'
+    )
+    parser.add_argument(
+        '--workers',
+        help='number of worker processes',
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        '--ignore-case',
+        help='match english keywords case-insensitively',
+        action='store_true',
+        default=cfg.keywords_ignore_case
+    )
+
+    args = parser.parse_args()
+
+    semesters = args.semesters or sorted(
+        name for name in os.listdir(args.root)
+        if os.path.isdir(os.path.join(args.root, name))
+    )
+
+    start_time = time.time()
+    workers = args.workers or WORKERS
+    total = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(args.ignore_case, CACHE_PATH)) as executor:
+        for semester in semesters:
+            folder = os.path.join(args.root, semester)
+            if not os.path.isdir(folder):
+                print('{0} not found'.format(folder))
+                continue
+            done, failures = analyse_semester(
+                executor, folder, args.output, workers * 4)
+            total += done
+            print('{0}: {1} files'.format(semester, done))
+            for fName, error in failures:
+                print('  no text from {0}: {1}'.format(fName, error))
+
+    elapsed_time = time.time() - start_time
+    print('Total {0} files, {1:.3f} second used.'.format(total, elapsed_time))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+'''
+throughput and allocation benchmark of the CCXP page parsers
+
+    python -m benchmarks.parsers [--fixtures DIR] [--save-baseline]
+
+Pages are read from DIR (default crawler/fixtures/): curriculum*.html,
+syllabus*.html and dept*.html, cp950 as CCXP serves them, so recorded pages
+can be dropped in next to the synthetic ones. Every case reports items/sec
+(best of --rounds) and the peak memory python allocated during one pass;
+tracemalloc does not see libxml2's own buffers.
+
+The run fails if any case got more than --threshold slower than its
+throughput in the baseline (see --save-baseline), or if there is no baseline
+to compare with; baselines are only comparable on the machine that recorded
+them.
+'''
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import lxml.html
+
+from crawler.course import (
+    course_from_syllabus, course_from_tr, curriculum_to_trs, decode
+)
+from crawler.crawler import dept_from_html, get_token
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'crawler', 'fixtures')
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+
+def load_pages(fixtures, kind):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(fixtures, kind + '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append(decode(f.read()))
+    return pages
+
+
+def cases(fixtures):
+    '''
+    [(name, unit, items, function applied to every item)]
+    '''
+    curricula = load_pages(fixtures, 'curriculum')
+    syllabi = load_pages(fixtures, 'syllabus')
+    depts = load_pages(fixtures, 'dept')
+
+    # course_from_tr alone: the rows are taken out of whole documents,
+    # which are kept alive, before timing
+    documents = [lxml.html.fromstring(html) for html in curricula]
+    rows = [
+        tr for document in documents
+        for tr in document.xpath("//tr[contains(@class, 'class3')]")[::2]
+    ]
+    course_times = [course_from_tr(tr)['time'] for tr in rows]
+    tokens = [
+        slots[i:i + 2] for slots in course_times
+        for i in range(0, len(slots), 2)
+    ]
+
+    return [
+        ('curriculum_to_trs', 'pages', curricula,
+         lambda html: sum(1 for _ in curriculum_to_trs(html))),
+        ('course_from_tr', 'rows', rows, course_from_tr),
+        ('course_from_syllabus', 'pages', syllabi, course_from_syllabus),
+        ('dept_from_html', 'pages', depts, dept_from_html),
+        ('get_token', 'tokens', tokens, get_token),
+    ]
+
+
+def throughput(items, function, rounds, min_time):
+    '''
+    best items per second of <rounds>, each round running at least
+    <min_time> seconds
+    '''
+    best = 0
+    for _ in range(rounds):
+        n = 0
+        start = time.perf_counter()
+        while True:
+            for item in items:
+                function(item)
+            n += len(items)
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, n / elapsed)
+    return best
+
+
+def peak_allocation(items, function):
+    '''
+    peak bytes allocated by python during one pass over items
+    '''
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for item in items:
+        function(item)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def run(fixtures, rounds, min_time):
+    results = {}
+    for name, unit, items, function in cases(fixtures):
+        if not items:
+            print('%-22s no fixtures' % name)
+            continue
+        results[name] = {
+            'unit': unit,
+            'items': len(items),
+            'per_sec': throughput(items, function, rounds, min_time),
+            'peak_bytes': peak_allocation(items, function),
+        }
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    print the results against baseline, returns the regressed case names
+    '''
+    regressions = []
+    print('%-22s %14s %12s %10s' % ('case', 'items/sec', 'peak KB', 'vs base'))
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratio = ''
+        if base:
+            change = result['per_sec'] / base['per_sec'] - 1
+            ratio = '%+.1f%%' % (change * 100)
+            if change < -threshold:
+                regressions.append(name)
+                ratio += ' !'
+        print('%-22s %8.0f %-5s %12.1f %10s' % (
+            name, result['per_sec'], result['unit'],
+            result['peak_bytes'] / 1024.0, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the CCXP page parsers'
+    )
+    parser.add_argument(
+        '--fixtures',
+        help='directory of cp950 pages (default: crawler/fixtures)',
+        default=FIXTURES
+    )
+    parser.add_argument(
+        '--baseline',
+        help='baseline json (default: benchmarks/baseline.json)',
+        default=BASELINE
+    )
+    parser.add_argument(
+        '--save-baseline',
+        help='record this run as the baseline instead of comparing',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--threshold',
+        help='allowed throughput loss against the baseline (default: 0.15)',
+        default=0.15,
+        type=float
+    )
+    parser.add_argument(
+        '--rounds',
+        help='timing rounds per case, the best counts',
+        default=5,
+        type=int
+    )
+    parser.add_argument(
+        '--min-time',
+        help='seconds per timing round',
+        default=0.2,
+        type=float
+    )
+    args = parser.parse_args()
+
+    results = run(args.fixtures, args.rounds, args.min_time)
+
+    if args.save_baseline:
+        compare(results, {}, args.threshold)
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('baseline saved to %s' % args.baseline)
+        sys.exit()
+
+    if not os.path.exists(args.baseline):
+        # baseline.json is not committed, a gate without one checks nothing
+        compare(results, {}, args.threshold)
+        sys.exit('no baseline at %s, run with --save-baseline first'
+                 % args.baseline)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('slower than baseline by more than %d%%: %s' % (
+            args.threshold * 100, ', '.join(regressions)))
+        sys.exit(1)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+'''
+micro-benchmark of course_from_syllabus: the compiled extraction plan
+against the absolute xpath strings it replaced
+
+    python -m benchmarks.syllabus_xpath [fixture.html ...]
+
+fixtures are saved syllabus pages (cp950), crawler/fixtures/ by default
+'''
+
+import argparse
+import glob
+import os
+import re
+import timeit
+
+import lxml.etree
+import lxml.html
+
+from crawler.course import (
+    course_from_syllabus, encoding, extract_multirow_text, extract_text, xpath0
+)
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'crawler', 'fixtures', 'syllabus*.html')
+
+
+def string_xpath_course_from_syllabus(html):
+    '''
+    course_from_syllabus before the compiled plan, for comparison
+    '''
+    document = lxml.html.fromstring(html, parser=lxml.etree.HTMLParser())
+
+    def xpath_text(xpath, joiner=''):
+        return extract_text(xpath0(document, xpath), joiner=joiner)
+
+    return {
+        'no': xpath_text('/html/body/div/table[1]/tr[2]/td[2]'),
+        'name_zh': xpath_text('/html/body/div/table[1]/tr[3]/td[2]'),
+        'name_en': xpath_text('/html/body/div/table[1]/tr[4]/td[2]'),
+        'credit': xpath_text('/html/body/div/table[1]/tr[2]/td[4]'),
+        'teacher': re.sub(r'\([^)]*\)', '', xpath_text(
+            '/html/body/div/table[1]/tr[5]/td[2]', joiner=', ')),
+        'time': xpath_text('/html/body/div/table[1]/tr[6]/td[2]'),
+        'room': xpath_text(
+            '/html/body/div/table[1]/tr[6]/td[4]', joiner=', '),
+        'syllabus': extract_multirow_text(
+            xpath0(document, '/html/body/div/table[5]/tr[2]/td')),
+        'has_attachment': bool(document.xpath(
+            '/html/body/div/table[5]/tr[2]/td/div/font[1]/a')),
+        'attachment_url': document.xpath(
+            '/html/body/div/table[5]/tr[2]/td/div/font[1]/a/@href')
+    }
+
+
+def bench(function, pages, number):
+    '''
+    best seconds per page of 5 rounds
+    '''
+    timer = timeit.Timer(lambda: [function(page) for page in pages])
+    return min(timer.repeat(5, number)) / number / len(pages)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark syllabus field extraction'
+    )
+    parser.add_argument(
+        'fixtures',
+        help='saved syllabus pages (default: crawler/fixtures/syllabus*.html)',
+        nargs='*'
+    )
+    parser.add_argument(
+        '--number',
+        help='passes over the fixtures per round',
+        default=200,
+        type=int
+    )
+    args = parser.parse_args()
+
+    paths = args.fixtures or sorted(glob.glob(FIXTURES))
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            pages.append(f.read().decode(encoding, 'replace'))
+
+    for page in pages:
+        assert course_from_syllabus(page) == \
+            string_xpath_course_from_syllabus(page)
+
+    old = bench(string_xpath_course_from_syllabus, pages, args.number)
+    new = bench(course_from_syllabus, pages, args.number)
+    print('%d fixtures' % len(pages))
+    print('string xpaths   %8.1f us/page' % (old * 1e6))
+    print('compiled plan   %8.1f us/page' % (new * 1e6))
+    print('speedup         %8.2fx' % (old / new))
@@ -411,6 +411,8 @@ keywords_list = [
     "主動性"
 ] 
 keywords_regex_compiled = [re.compile(e) for e in keywords_list]
+# count "Global" as "global" etc. in keyword analysis
+keywords_ignore_case = False
 
 great_teacher_dict = {
     "099":['王俊堯','王炳豐','朱筱蕾','江啟勳','吳振名','巫勇賢','李大麟','李卓穎','李昇憲','李',' 敏','沈昭亮','汪宏達','林秀豪','林昭安','姚人多','洪毓玨','胡啟章','徐碩鴻','高茂傑','許雅三','陳建忠','陳舜文','游萃蓉','焦傳金','黃忠正','黃裕烈','楊家銘','蔡仁松','蔡宏營','蔡東和','鄭少為','鄭桂忠','戴明鳳','瞿志行','蘇宜青','蘇怡如''王立邦','吳振名','唐述中','唐震宏','馬孟晶','張焯然','張寶塔','陳舜文','陳傳興','程守慶','黃朝熙','廖信銳','齊正中','劉怡維','鄭志鵬','蕭嫣嫣','戴明鳳'],
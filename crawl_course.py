@@ -7,24 +7,41 @@ import subprocess
 
 import re
 
-from crawler.crawler import crawl_course, crawl_dept
-from crawler.course import get_cou_codes, course_from_syllabus
+from crawler.crawler import crawl_course, crawl_dept, crawl_syllabus
+from crawler.course import (
+    get, get_cou_codes, course_from_syllabus, crawler_config, form_url
+)
+from crawler.checkpoint import checkpoint_for
 try:
-    from crawler.decaptcha import Entrance, DecaptchaFailure
+    from crawler.decaptcha import (
+        DecaptchaFailure, TicketPool, get_default_recogniser
+    )
 except ImportError:
-    Entrance = None
+    ticket_pool = None
+else:
+    try:
+        get_default_recogniser()
+    except DecaptchaFailure:
+        ticket_pool = None
+    else:
+        ticket_pool = TicketPool()
+
+import argparse
+from config import cou_codes as course_code
+
+course_form_url = form_url
+dept_form_url = crawler_config['dept_form_url']
 
-import requests
-from config import course_code
 
 def get_auth_pair(url):
-    if Entrance is not None:
+    if ticket_pool is not None:
         try:
-            return Entrance(url).get_ticket()
+            return ticket_pool.get_ticket(url)
         except DecaptchaFailure:
             print('Automated decaptcha failed.')
     else:
-        print('crawler.decaptcha not available (requires tesseract >= 3.03).')
+        print('crawler.decaptcha not available (requires tesseract >= 3.03 '
+              'or a template_corpus).')
     print('Please provide valid ACIXSTORE and auth_num from')
     print(url)
     ACIXSTORE = input('ACIXSTORE: ')
@@ -32,6 +49,19 @@ def get_auth_pair(url):
     return ACIXSTORE, auth_num
 
 
+def close_checkpoint(checkpoint, report):
+    '''
+    forget the journal of a complete crawl, keep it if pages failed so the
+    next run crawls only those again
+    '''
+    if report.failed:
+        checkpoint.close()
+        print('%d pages failed, run again to retry them '
+              '(--fresh starts over)' % report.failed)
+    else:
+        checkpoint.remove()
+
+
 class Command():
     args = ''
     help = 'Help crawl the course data from NTHU.'
@@ -40,22 +70,47 @@ class Command():
         if len(args) == 0:
             import time
             start_time = time.time()
+            if ticket_pool is not None:
+                # solve captchas while the other phase is crawling
+                ticket_pool.prefetch(course_form_url)
+                ticket_pool.prefetch(dept_form_url)
             cou_codes = get_cou_codes()
             for ys in ['105|20']:
-                ACIXSTORE, auth_num = get_auth_pair(
-                    'https://www.ccxp.nthu.edu.tw/ccxp/INQUIRE'
-                    '/JH/6/6.2/6.2.9/JH629001.php'
-                )
+                ACIXSTORE, auth_num = get_auth_pair(course_form_url)
+                job = ('crawl_syllabus' if kwargs.get('syllabus_only')
+                       else 'crawl_course')
+                checkpoint = checkpoint_for(job, ys)
+                if kwargs.get('fresh'):
+                    checkpoint.remove()
+                    checkpoint = checkpoint_for(job, ys)
+                if kwargs.get('syllabus_only'):
+                    print('Crawling syllabus for ' + ys)
+                    report = crawl_syllabus(
+                        ACIXSTORE, ys,
+                        parse_workers=kwargs.get('parse_workers'),
+                        batch_size=kwargs.get('batch_size'),
+                        checkpoint=checkpoint,
+                        refresh_ticket=lambda: get_auth_pair(
+                            course_form_url))
+                    close_checkpoint(checkpoint, report)
+                    continue
                 print('Crawling course for ' + ys)
-                crawl_course(ACIXSTORE, auth_num, cou_codes, ys)
-
-                ACIXSTORE, auth_num = get_auth_pair(
-                    'https://www.ccxp.nthu.edu.tw/ccxp/INQUIRE'
-                    '/JH/6/6.2/6.2.3/JH623001.php'
-                )
+                report = crawl_course(
+                    ACIXSTORE, auth_num, cou_codes, ys,
+                    parse_workers=kwargs.get('parse_workers'),
+                    batch_size=kwargs.get('batch_size'),
+                    checkpoint=checkpoint,
+                    refresh_ticket=lambda: get_auth_pair(course_form_url))
+                close_checkpoint(checkpoint, report)
+
+                ACIXSTORE, auth_num = get_auth_pair(dept_form_url)
                 print('Crawling dept for ' + ys)
-                crawl_dept(ACIXSTORE, auth_num, cou_codes, ys)
+                crawl_dept(ACIXSTORE, auth_num, cou_codes, ys,
+                           refresh_ticket=lambda: get_auth_pair(
+                               dept_form_url))
                 print('===============================\n')
+            if ticket_pool is not None:
+                ticket_pool.shutdown()
             elapsed_time = time.time() - start_time
             print('Total %.3f second used.' % elapsed_time)
         if len(args) == 1:
@@ -66,11 +121,51 @@ class Command():
 if __name__ == '__main__':
     # aci, auth = get_auth_pair()
     # print(crawler.course.get_syllabus(ACIXSTORE, "10510EE  152000"))
-    # a = Command()
-    # a.handle()
 
-    
-    res = requests.get(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description='Crawl the course data from NTHU'
+    )
+    parser.add_argument(
+        'syllabus_url',
+        help='save this syllabus to a txt file instead of crawling',
+        nargs='?',
+        default=None
+    )
+    parser.add_argument(
+        '--parse-workers',
+        help='number of html parsing processes (0 to parse inline)',
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        '--batch-size',
+        help='number of courses per bulk database write',
+        default=None,
+        type=int
+    )
+
+    parser.add_argument(
+        '--fresh',
+        help='ignore the checkpoint of an interrupted crawl and start over',
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--syllabus-only',
+        help='only crawl the syllabi of courses already in the database',
+        action='store_true'
+    )
+
+    args = parser.parse_args()
+
+    if args.syllabus_url is None:
+        Command().handle(parse_workers=args.parse_workers,
+                         batch_size=args.batch_size,
+                         fresh=args.fresh,
+                         syllabus_only=args.syllabus_only)
+        sys.exit()
+
+    res = get(args.syllabus_url)
     # print(type(res.encoding))
     res.encoding = "cp950"
 
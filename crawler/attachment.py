@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from requests.exceptions import ConnectionError, Timeout
+
+from utils.config import get_config_section
+from crawler import transport
+from crawler.ratelimit import Backoff, count, host_slot
+
+logger = logging.getLogger(__name__)
+
+attachment_config = get_config_section('attachment')
+
+WORKERS = int(attachment_config.get('workers', 4))
+CHUNK_SIZE = int(attachment_config.get('chunk_size', 1 << 16))
+
+# response headers that identify a version of a file
+VALIDATORS = ('ETag', 'Last-Modified')
+
+
+def meta_path(path):
+    '''
+    the sidecar file holding size and validators of a downloaded file
+    '''
+    return path + '.meta'
+
+
+def read_meta(path):
+    '''
+    the sidecar of path, None unless both the file and a sidecar matching
+    its size exist
+    '''
+    try:
+        with open(meta_path(path), encoding='utf-8') as f:
+            meta = json.load(f)
+        size = os.path.getsize(path)
+    except (OSError, ValueError):
+        return None
+    if meta.get('size') != size:
+        return None
+    return meta
+
+
+def part_file(path):
+    '''
+    (fd, name) of a new temporary file next to path, to be renamed to it
+    '''
+    return tempfile.mkstemp(
+        suffix='.part', prefix=os.path.basename(path) + '.',
+        dir=os.path.dirname(path) or '.')
+
+
+def write_meta(path, meta):
+    fd, tmp_path = part_file(meta_path(path))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path(path))
+
+
+def is_current(meta, response):
+    '''
+    whether the local file described by meta is what response would send
+    '''
+    if response.status_code == 304:
+        return True
+    if response.status_code != 200:
+        return False
+    length = response.headers.get('Content-Length')
+    if length is None or int(length) != meta['size']:
+        return False
+    validators = [
+        name for name in VALIDATORS if response.headers.get(name)
+    ]
+    return bool(validators) and all(
+        meta.get(name) == response.headers[name] for name in validators
+    )
+
+
+def download(url, path, chunk_size=None, retries=3):
+    '''
+    stream url to path, returns 'skipped' if path already holds it
+
+    The body is written in chunks to a temporary file next to path and
+    renamed to path once complete, so path is either missing or whole. Size, ETag and
+    Last-Modified go to a sidecar (see meta_path), the next download sends
+    them as conditional headers and keeps the file if the server answers
+    304 or the same validators.
+    '''
+    chunk_size = chunk_size or CHUNK_SIZE
+    meta = read_meta(path)
+    headers = {}
+    if meta is not None:
+        if meta.get('ETag'):
+            headers['If-None-Match'] = meta['ETag']
+        if meta.get('Last-Modified'):
+            headers['If-Modified-Since'] = meta['Last-Modified']
+
+    backoff = Backoff()
+    for try_ in range(retries + 1):
+        if try_:
+            count('retries')
+            backoff.sleep(try_ - 1)
+        part_path = None
+        count('requests')
+        try:
+            # a download holds one of the host's request slots until the
+            # whole body is written
+            with host_slot(urlsplit(url).netloc), \
+                    transport.get(url, headers=headers, stream=True) as response:
+                if meta is not None and is_current(meta, response):
+                    count('attachments_skipped')
+                    return 'skipped'
+                if response.status_code >= 500:
+                    count('server_errors')
+                    continue
+                response.raise_for_status()
+                size = 0
+                fd, part_path = part_file(path)
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size):
+                        f.write(chunk)
+                        size += len(chunk)
+                os.replace(part_path, path)
+                new_meta = {'size': size}
+                for name in VALIDATORS:
+                    if response.headers.get(name):
+                        new_meta[name] = response.headers[name]
+                write_meta(path, new_meta)
+        except (Timeout, ConnectionError) as e:
+            count('timeouts' if isinstance(e, Timeout) else 'errors')
+            if try_ == retries:
+                raise
+            continue
+        finally:
+            if part_path is not None and os.path.exists(part_path):
+                os.remove(part_path)
+        count('attachments_downloaded')
+        count('attachment_bytes', size)
+        return 'downloaded'
+    raise IOError('%s: server error' % url)
+
+
+class AttachmentDownloader(object):
+    '''
+    downloads attachments on <workers> threads of their own, so large
+    files do not hold up syllabus crawling; a running download counts
+    against the host's request limit like any other request
+
+    submit(url, path, then) queues a download(), then(path) is called on
+    the download thread once the file is in place. A path already being
+    downloaded (a course listed by two departments) is not downloaded
+    twice, its then is called when the running download is done. Failures
+    are printed and counted in .failed.
+    '''
+    def __init__(self, workers=None, chunk_size=None):
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.failed = 0
+        self._lock = threading.Lock()
+        # path: (future, [then]) of queued and running downloads
+        self._pending = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers or WORKERS)
+
+    def _fail(self, message):
+        with self._lock:
+            self.failed += 1
+        count('attachment_failures')
+        print(message)
+        traceback.print_exc()
+
+    def _download(self, url, path):
+        try:
+            status = download(url, path, self.chunk_size)
+        except Exception:
+            status = None
+            self._fail('Downloading %s to %s failed:' % (url, path))
+        # a path submitted from now on is downloaded again
+        with self._lock:
+            _, thens = self._pending.pop(path)
+        if status is None:
+            return
+        print('{0} {1}'.format(
+            'Create' if status == 'downloaded' else 'Keep',
+            os.path.basename(path)))
+        for then in thens:
+            try:
+                then(path)
+            except Exception:
+                self._fail('Handling %s failed:' % path)
+
+    def submit(self, url, path, then=None):
+        with self._lock:
+            if path in self._pending:
+                future, thens = self._pending[path]
+            else:
+                future, thens = None, []
+            if then is not None:
+                thens.append(then)
+            if future is None:
+                future = self._executor.submit(self._download, url, path)
+                self._pending[path] = (future, thens)
+            return future
+
+    def shutdown(self):
+        '''
+        wait for every queued download
+        '''
+        self._executor.shutdown(wait=True)
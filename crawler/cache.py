@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from utils.config import ROOT_DIR, get_config_section
+from config import year_semester_dict
+
+logger = logging.getLogger(__name__)
+
+cache_config = get_config_section('cache')
+
+# session tokens, a fresh pair is used on every run
+VOLATILE_KEYS = ('ACIXSTORE', 'auth_num')
+
+FOREVER = float('inf')
+
+
+def request_ys(url, params=None, data=None):
+    '''
+    guess which semester a CCXP request is about, returns 'yyy|tt' or None
+    '''
+    fields = dict(params or {})
+    fields.update(data or {})
+    if 'YS' in fields:
+        return fields['YS']
+    if 'T_YEAR' in fields and 'C_TERM' in fields:
+        return '%s|%s' % (fields['T_YEAR'], fields['C_TERM'])
+    # course numbers look like 10520EE  152000
+    no = fields.get('c_key') or os.path.basename(url)
+    match = re.match(r'(\d{3})(\d{2})[A-Z]', no)
+    if match:
+        return '%s|%s' % match.groups()
+    return None
+
+
+class TTLPolicy(object):
+    '''
+    decides how long a response may be served from the cache
+
+    uncached_urls   urls that always go to the network (they hand out new
+                    ACIXSTOREs)
+    current_ys      semesters before this one never change, cache forever
+    ttl             seconds for everything else
+    '''
+    def __init__(self, uncached_urls=(), current_ys=None, ttl=3600):
+        self.uncached_urls = set(uncached_urls)
+        self.current_ys = current_ys or max(year_semester_dict)
+        self.ttl = ttl
+
+    def __call__(self, url, params=None, data=None):
+        if url in self.uncached_urls:
+            return 0
+        ys = request_ys(url, params, data)
+        if ys is not None and ys < self.current_ys:
+            return FOREVER
+        return self.ttl
+
+
+class ResponseCache(object):
+    '''
+    on-disk http response cache
+
+    Entries are keyed by a hash of method, url and request fields, leaving
+    out VOLATILE_KEYS. Once the directory grows over <max_size> bytes the
+    least recently used entries are removed. The directory is created by
+    the first set(), and the cache may be shared by threads.
+    '''
+    def __init__(self, path, max_size, policy):
+        self.path = path
+        self.max_size = max_size
+        self.policy = policy
+        self._size = None
+        # guards _size and eviction
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def key(method, url, params=None, data=None):
+        def fields(d):
+            return sorted(
+                (k, v) for k, v in (d or {}).items()
+                if k not in VOLATILE_KEYS
+            )
+        identity = json.dumps(
+            [method.lower(), url, fields(params), fields(data)],
+            ensure_ascii=False
+        )
+        return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, method, url, params=None, data=None):
+        '''
+        returns the cached requests.Response or None
+        '''
+        path = self._entry_path(self.key(method, url, params, data))
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if entry['expires'] < time.time():
+            return None
+        try:
+            os.utime(path)  # mark as recently used
+        except OSError:
+            pass  # evicted since it was read
+        response = requests.Response()
+        response.status_code = entry['status_code']
+        response.url = entry['url']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['content']
+        return response
+
+    def set(self, method, url, response, params=None, data=None):
+        if response.status_code != 200 or not response.content:
+            return
+        ttl = self.policy(url, params, data)
+        if not ttl:
+            return
+        path = self._entry_path(self.key(method, url, params, data))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = {
+            'url': response.url,
+            'status_code': response.status_code,
+            'headers': dict(response.headers),
+            'content': response.content,
+            'expires': time.time() + ttl,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f)
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            os.replace(tmp_path, path)
+            if self._size is not None:
+                self._size += size
+            if self.size() > self.max_size:
+                self.evict()
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def size(self):
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            return self._size
+
+    def evict(self):
+        '''
+        remove least recently used entries until the cache is at 90% of
+        max_size
+        '''
+        with self._lock:
+            entries = sorted(self._entries())
+            size = sum(size for _, size, _ in entries)
+            for mtime, entry_size, path in entries:
+                if size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                size -= entry_size
+                logger.debug('evicted %s', path)
+            self._size = size
+
+
+def default_cache():
+    '''
+    the cache configured in the [cache] section, None if disabled
+    '''
+    path = cache_config.get('path')
+    if not path:
+        return None
+    crawler_config = get_config_section('crawler')
+    return ResponseCache(
+        os.path.join(ROOT_DIR, path),
+        int(cache_config.get('max_size', 1 << 30)),
+        TTLPolicy(
+            uncached_urls=[crawler_config.get('form_url')],
+            current_ys=cache_config.get('current_ys'),
+            ttl=int(cache_config.get('ttl', 3600)),
+        )
+    )
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+
+from utils.config import ROOT_DIR, get_config_section
+
+checkpoint_config = get_config_section('checkpoint')
+
+
+class Checkpoint(object):
+    '''
+    durable journal of finished work, so an interrupted crawl can resume
+
+    Each finished piece of work is a key (a tuple of strings) with an
+    optional json value. mark() appends one json line and fsyncs it, a torn
+    last line from a crash is ignored when the journal is read back.
+    mark() may be called from several threads.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        line = '\n'
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[tuple(key)] = value
+        else:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+        if not line.endswith('\n'):
+            # end the torn line so the next mark starts on its own
+            self._file.write('\n')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def done(self, *key):
+        return key in self.entries
+
+    def get(self, *key):
+        return self.entries.get(key)
+
+    def mark(self, *key, **kwargs):
+        '''
+        mark(kind, ..., value=None)
+        '''
+        value = kwargs.get('value')
+        line = json.dumps([key, value], ensure_ascii=False) + '\n'
+        with self._lock:
+            self.entries[key] = value
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def keys(self, kind):
+        '''
+        keys starting with kind, without it
+        '''
+        return [key[1:] for key in self.entries if key[0] == kind]
+
+    def close(self):
+        self._file.close()
+
+    def remove(self):
+        '''
+        the work is complete, forget it so the next run starts over
+        '''
+        self.close()
+        os.remove(self.path)
+
+
+def checkpoint_for(name, ys):
+    '''
+    the Checkpoint of job <name> for semester ys, under the configured path
+    '''
+    return Checkpoint(os.path.join(
+        ROOT_DIR,
+        checkpoint_config.get('path') or 'checkpoints',
+        '%s-%s.journal' % (name, ys.replace('|', '-'))
+    ))
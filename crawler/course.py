@@ -2,16 +2,29 @@
 # Jordan huang<good5dog5@gmail.com>
 
 
+import logging
 import os
 import sys
 import subprocess
-import requests
+import threading
+import time
 import lxml.html
 import re
 from itertools import zip_longest
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from requests.exceptions import ConnectionError, Timeout
 
 from utils.config import get_config_section
 from config import course_dict
+from crawler.cache import default_cache
+from crawler import transport
+from crawler.ratelimit import Backoff, count, get_controller, host_slot
+
+logger = logging.getLogger(__name__)
 
 crawler_config      = get_config_section('crawler')
 encoding            = crawler_config['encoding']  # big5 superset
@@ -22,13 +35,18 @@ syllabus_url        = crawler_config['syllabus_url']
 attachment_url      = crawler_config['attachment_url']
 dept_url            = crawler_config['dept_url']
 
+response_cache      = default_cache()
 
-def xpath0(element, xpath):
-    result = element.xpath(xpath)
+
+def only(result):
     assert len(result) == 1, result
     return result[0]
 
 
+def xpath0(element, xpath):
+    return only(element.xpath(xpath))
+
+
 def extract_text(element, joiner=''):
     return joiner.join(element.itertext()).replace(" ", "")
 
@@ -53,24 +71,153 @@ def extract_multirow_text(element):
 
 class EmptyResponse(Exception):
     pass
+
+
+class SessionExpired(Exception):
+    pass
+
+
+class WrongCheckCode(SessionExpired):
+    '''
+    CCXP rejected the ticket's auth_num, the ticket has to be renewed just
+    like an expired one
+    '''
+    pass
+
+
+def is_session_expired(response):
+    '''
+    CCXP answers with a short "session interrupted" page once an ACIXSTORE
+    expires, see crawler.decaptcha.Entrance.validate_by_post; a long page
+    merely mentioning the word is real content
+    '''
+    content = response.content
+    return len(content) < 4096 and b'interrupted' in content
+
+
+def is_wrong_check_code(response):
+    '''
+    CCXP answers with a short "Wrong check code" page to a post with a wrong
+    auth_num, see crawler.decaptcha.Entrance.validate_by_post
+    '''
+    content = response.content
+    return len(content) < 4096 and b'Wrong check code' in content
+
+
+def is_ticket_page(response):
+    '''
+    whether response is one of the pages about the ticket instead of data,
+    these are never cached
+    '''
+    return is_session_expired(response) or is_wrong_check_code(response)
+
+
+class Ticket(object):
+    '''
+    the (acixstore, auth_num) pair a crawl is using
+
+    refresh() should return a new pair, it is called by renew() when CCXP
+    ends the session
+    '''
+    def __init__(self, acixstore, auth_num, refresh=None):
+        self.acixstore = acixstore
+        self.auth_num = auth_num
+        self.refresh = refresh
+        self._lock = threading.Lock()
+
+    def renew(self, stale_acixstore):
+        '''
+        get a new pair unless another thread already replaced stale_acixstore
+        raises SessionExpired if there is no refresh function
+        '''
+        with self._lock:
+            if self.acixstore != stale_acixstore:
+                return
+            if self.refresh is None:
+                raise SessionExpired(stale_acixstore)
+            logger.info('session %r expired, getting a new ticket',
+                        stale_acixstore)
+            self.acixstore, self.auth_num = self.refresh()
+            count('session_refreshes')
+
+    def call(self, function, retries=3):
+        '''
+        returns function(acixstore, auth_num), renewing the ticket and calling
+        again if the session expired
+        '''
+        for try_ in range(retries):
+            acixstore = self.acixstore
+            try:
+                return function(acixstore, self.auth_num)
+            except SessionExpired:
+                self.renew(acixstore)
+        return function(self.acixstore, self.auth_num)
+
+
 def with_retry(request_function):
+    method = request_function.__name__
+    backoff = Backoff()
+
     def function(url, max_retries=32, **kwargs):
         '''
         get a valid response in <max_retries> retries
+        answer from response_cache if possible
+        empty bodies, 5xx responses, timeouts and connection errors are
+        retried after a jittered exponential backoff; every try waits for a
+        slot of the host (see crawler.ratelimit.host_slot) and is reported
+        to the host's AIMDController
         change encoding before return
-        raises EmptyResponse if not valid
+        raises EmptyResponse if not valid, or the last network error
+        raises SessionExpired if CCXP says the ACIXSTORE session is over,
+        WrongCheckCode if it rejects the auth_num
         '''
+        params = kwargs.get('params')
+        data = kwargs.get('data')
+        if response_cache is not None:
+            response = response_cache.get(method, url, params, data)
+            # ticket pages cached before they were recognised are ignored
+            if response is not None and not is_ticket_page(response):
+                response.encoding = encoding
+                return response
+        host = urlsplit(url).netloc
+        controller = get_controller(host)
+        error = EmptyResponse(url)
         for r in range(max_retries):
-            response = request_function(url, **kwargs)
-            if response.content:
+            if r:
+                count('retries')
+                backoff.sleep(r - 1)
+            count('requests')
+            with host_slot(host):
+                # the server's latency, not the wait for a slot
+                start = time.time()
+                try:
+                    response = request_function(url, **kwargs)
+                except (Timeout, ConnectionError) as e:
+                    controller.record(time.time() - start, False)
+                    count('timeouts' if isinstance(e, Timeout) else 'errors')
+                    error = e
+                    continue
+                latency = time.time() - start
+            ok = response.status_code < 500 and bool(response.content)
+            controller.record(latency, ok)
+            if ok and is_session_expired(response):
+                count('session_expired')
+                raise SessionExpired(url)
+            if ok and is_wrong_check_code(response):
+                count('wrong_check_code')
+                raise WrongCheckCode(url)
+            if ok:
+                if response_cache is not None:
+                    response_cache.set(method, url, response, params, data)
                 response.encoding = encoding
                 return response
-        raise EmptyResponse(url)
+            count('server_errors' if response.content else 'empty')
+            error = EmptyResponse(url)
+        raise error
     function.__name__ = request_function.__name__
     return function
 
 
-
 def get_slfr(text):
     sl, s, fr = text.partition(u'新生保留')
     if not sl:
@@ -84,14 +231,49 @@ def get_slfr(text):
     return sl, fr
 
 
-get = with_retry(requests.get)
-post = with_retry(requests.post)
+get = with_retry(transport.get)
+post = with_retry(transport.post)
 
-def curriculum_to_trs(html):
-    document = lxml.html.fromstring(html)
-    course_trs = document.xpath("//tr[contains(@class, 'class3')]")
-    assert len(course_trs) % 2 == 0, len(course_trs)
-    return course_trs[::2]
+def _release(tr):
+    '''
+    free a handled row and the rows before it
+    '''
+    tr.clear()
+    parent = tr.getparent()
+    if parent is not None:
+        while tr.getprevious() is not None:
+            del parent[0]
+
+
+def curriculum_to_trs(html, chunk_size=1 << 16):
+    '''
+    curriculum html -> the main row of every course, one at a time
+
+    Every course has two ``class3`` rows, the second is skipped. The page is
+    fed to an incremental parser <chunk_size> characters at a time and rows
+    are yielded as soon as they are complete, then freed with the rows
+    before them, so the page never exists as a whole DOM. A row is only
+    valid until the next one is requested.
+    '''
+    parser = lxml.etree.HTMLPullParser(events=('end',), tag='tr')
+    class3_count = 0
+    for start in range(0, len(html) + 1, chunk_size):
+        chunk = html[start:start + chunk_size]
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        for _, tr in parser.read_events():
+            if 'class3' in (tr.get('class') or ''):
+                class3_count += 1
+                if class3_count % 2:
+                    yield tr
+                _release(tr)
+            elif not any('class3' in (row.get('class') or '')
+                         for row in tr.iterancestors('tr')):
+                # a row of its own, not part of a course row
+                _release(tr)
+    assert class3_count % 2 == 0, class3_count
 
 
 def course_from_tr(main_tr):
@@ -142,6 +324,25 @@ def course_from_tr(main_tr):
     return part
 
 
+# course_from_syllabus extraction plan, compiled once: the two tables holding
+# every field are found from the root, the fields relative to them
+syllabus_info_table = lxml.etree.XPath('/html/body/div/table[1]')
+syllabus_content_cell = lxml.etree.XPath('/html/body/div/table[5]/tr[2]/td')
+syllabus_info_cells = {
+    field: lxml.etree.XPath(path)
+    for field, path in [
+        ('no', 'tr[2]/td[2]'),
+        ('name_zh', 'tr[3]/td[2]'),
+        ('name_en', 'tr[4]/td[2]'),
+        ('credit', 'tr[2]/td[4]'),
+        ('teacher', 'tr[5]/td[2]'),
+        ('time', 'tr[6]/td[2]'),
+        ('room', 'tr[6]/td[4]'),
+    ]
+}
+syllabus_attachment_links = lxml.etree.XPath('div/font[1]/a')
+
+
 def course_from_syllabus(html):
     '''
     syllabus html -> dict: course data
@@ -161,12 +362,11 @@ def course_from_syllabus(html):
     where <no> is the course number
     '''
     document = lxml.html.fromstring(html,parser = lxml.etree.HTMLParser())
+    info = only(syllabus_info_table(document))
+    content = only(syllabus_content_cell(document))
 
-    def xpath_text(xpath, joiner=''):
-        return extract_text(xpath0(document, xpath), joiner=joiner)
-
-    def xpath_int(xpath):
-        return extract_int(xpath0(document, xpath))
+    def info_text(field, joiner=''):
+        return extract_text(only(syllabus_info_cells[field](info)), joiner=joiner)
 
     def patch_teacher(text):
         '''
@@ -176,28 +376,52 @@ def course_from_syllabus(html):
         '''
         return re.sub(r'\([^)]*\)', '', text)
 
+    links = syllabus_attachment_links(content)
+
     return {
-        'no': xpath_text('/html/body/div/table[1]/tr[2]/td[2]'),
-        'name_zh': xpath_text('/html/body/div/table[1]/tr[3]/td[2]'),
-        'name_en': xpath_text('/html/body/div/table[1]/tr[4]/td[2]'),
-        'credit': xpath_text('/html/body/div/table[1]/tr[2]/td[4]'),
-        'teacher': patch_teacher(xpath_text(
-            '/html/body/div/table[1]/tr[5]/td[2]', joiner=', ')),
-        'time': xpath_text('/html/body/div/table[1]/tr[6]/td[2]'),
-        'room': xpath_text('/html/body/div/table[1]/tr[6]/td[4]', joiner=', '),
-        'syllabus': extract_multirow_text(
-            xpath0(document, '/html/body/div/table[5]/tr[2]/td')),
-        'has_attachment': bool( document.xpath('/html/body/div/table[5]/tr[2]/td/div/font[1]/a')),
-        'attachment_url': document.xpath('/html/body/div/table[5]/tr[2]/td/div/font[1]/a/@href')
+        'no': info_text('no'),
+        'name_zh': info_text('name_zh'),
+        'name_en': info_text('name_en'),
+        'credit': info_text('credit'),
+        'teacher': patch_teacher(info_text('teacher', joiner=', ')),
+        'time': info_text('time'),
+        'room': info_text('room', joiner=', '),
+        'syllabus': extract_multirow_text(content),
+        'has_attachment': bool(links),
+        'attachment_url': [
+            link.get('href') for link in links if link.get('href') is not None
+        ]
     }
 
 
+def decode(content):
+    return content.decode(encoding, 'replace')
+
+
+def parse_curriculum(content):
+    '''
+    raw curriculum page bytes -> list of course dicts, see course_from_tr
+
+    takes and returns only picklable values so it can run in a worker process
+    '''
+    return [course_from_tr(tr) for tr in curriculum_to_trs(decode(content))]
+
+
+def parse_syllabus(content):
+    '''
+    raw syllabus page bytes -> course dict, see course_from_syllabus
+
+    takes and returns only picklable values so it can run in a worker process
+    '''
+    return course_from_syllabus(decode(content))
+
+
 def get_syllabus(c_key, acixstore):
     return get(syllabus_url, params={'c_key': c_key, 'ACIXSTORE': acixstore})
 
 
-def get_cou_codes(url):
-    html = get(form_url).text
+def get_cou_codes(url=None):
+    html = get(url or form_url).text
     document = lxml.html.fromstring(html)
     return document.xpath('//select[@name="cou_code"]/option/@value')
 
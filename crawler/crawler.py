@@ -3,30 +3,42 @@
 
 import re
 import bs4
+import hashlib
+import itertools
+import json
 import traceback
-# import progressbar
-from itertools import zip_longest
-from requests_futures.sessions import FuturesSession
 from config import week_dict, course_dict
 
 
 from crawler.course import (
     curriculum_to_trs, course_from_tr, syllabus_url, course_from_syllabus,
-    form_action_url, dept_url, encoding
+    form_action_url, dept_url, parse_curriculum, parse_syllabus,
+    crawler_config, Ticket
 )
+from crawler.engine import CrawlEngine, Request
+from crawler.ratelimit import format_metrics
 from data_center.models import Course, Department
 
-MAX_WORKERS = 8  # max_workers for FuturesSession
+try:
+    from haystack import connections as search_connections
+    from haystack.exceptions import NotHandled
+except ImportError:
+    search_connections = None
+
+BATCH_SIZE = int(crawler_config.get('batch_size', 500))
 
 def ys_2_year_term(ys):
     return tuple(ys.split('|'))
 
 
-def dept_2_future(session, dept, acixstore, auth_num, ys):
+def dept_2_request(dept, acixstore, auth_num, ys, ticket=None):
     year, term = ys_2_year_term(ys)
 
-    return session.post(
+    return Request(
+        'post',
         dept_url,
+        context=dept,
+        ticket=ticket,
         data={
             'SEL_FUNC': 'DEP',
             'ACIXSTORE': acixstore,
@@ -36,9 +48,13 @@ def dept_2_future(session, dept, acixstore, auth_num, ys):
             'auth_num': auth_num})
 
 
-def cou_code_2_future(session, cou_code, acixstore, auth_num, ys):
-    return session.post(
+def cou_code_2_request(cou_code, acixstore, auth_num, ys, ticket=None):
+    return Request(
+        'post',
         form_action_url,
+        context=cou_code,
+        parser=parse_curriculum,
+        ticket=ticket,
         data={
             'ACIXSTORE': acixstore,
             'YS': ys,  # year|term
@@ -47,31 +63,112 @@ def cou_code_2_future(session, cou_code, acixstore, auth_num, ys):
             'auth_num': auth_num})
 
 
+def fingerprint(data):
+    '''
+    stable hash of parsed page data, tells whether a page changed since the
+    last crawl
+    '''
+    return hashlib.sha1(json.dumps(
+        data, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    ).hexdigest()
+
+
+class CrawlReport(object):
+    '''
+    counts crawled courses as new, changed or unchanged
+
+    a course is reported once with its most significant status, .failed
+    counts the pages that could not be fetched or parsed
+    '''
+    STATUSES = ('unchanged', 'changed', 'new')
+
+    def __init__(self):
+        self.status = {}
+        self.failed = 0
+
+    def record(self, no, status):
+        if status not in self.STATUSES:
+            return
+        old = self.status.get(no, 'unchanged')
+        self.status[no] = max(
+            old, status, key=self.STATUSES.index)
+
+    def counts(self):
+        return dict(
+            (status, list(self.status.values()).count(status))
+            for status in self.STATUSES
+        )
+
+    def __str__(self):
+        counts = self.counts()
+        counts['failed'] = self.failed
+        return 'new: %(new)d, changed: %(changed)d, unchanged: %(unchanged)d, failed: %(failed)d' % counts  # noqa
+
+
 def save_syllabus(html, course, ys):
     try:
         course_dict = course_from_syllabus(html)
-
-        course.chi_title = course_dict['name_zh']
-        course.eng_title = course_dict['name_en']
-        course.credit = course_dict['credit']
-        course.time = course_dict['time']
-        course.time_token = get_token(course_dict['time'])
-        course.teacher = course_dict['teacher']
-        course.room = course_dict['room']
-        course.syllabus = course_dict['syllabus']
-        course.has_attachment = course_dict['has_attachment']
-        course.ys = ys
+    except:
+        print(traceback.format_exc())
+        print(course)
+        return 'QAQ, what can I do?'
+    return save_syllabus_dict(course_dict, course, ys)
+
+
+def update_syllabus(course, course_dict, ys):
+    '''
+    copy a parsed syllabus into course without saving it
+
+    returns False if the syllabus is the same as last time
+    '''
+    syllabus_fingerprint = fingerprint([course_dict, ys])
+    if course.syllabus_fingerprint == syllabus_fingerprint:
+        return False
+    course.chi_title = course_dict['name_zh']
+    course.eng_title = course_dict['name_en']
+    course.credit = course_dict['credit']
+    course.time = course_dict['time']
+    course.time_token = get_token(course_dict['time'])
+    course.teacher = course_dict['teacher']
+    course.room = course_dict['room']
+    course.syllabus = course_dict['syllabus']
+    course.has_attachment = course_dict['has_attachment']
+    course.ys = ys
+    course.syllabus_fingerprint = syllabus_fingerprint
+    return True
+
+
+def save_syllabus_dict(course_dict, course, ys):
+    '''
+    course_dict: parsed syllabus, see crawler.course.course_from_syllabus
+
+    returns 'changed', or 'unchanged' if the course is not written because
+    the syllabus is the same as last time
+    '''
+    try:
+        if not update_syllabus(course, course_dict, ys):
+            return 'unchanged'
         course.save()
+        return 'changed'
     except:
         print(traceback.format_exc())
         print(course)
         return 'QAQ, what can I do?'
 
 
-def collect_class_info(tr, cou_code):
-    course_dict = course_from_tr(tr)
+def update_class_info(course, course_dict, cou_code):
+    '''
+    copy a parsed curriculum row listed under cou_code into course without
+    saving it, cou_code is appended to course.code
 
-    course, create = Course.objects.get_or_create(no=course_dict['no'])
+    returns False if nothing changed since last time
+    '''
+    curriculum_fingerprint = fingerprint(course_dict)
+    if (
+        cou_code in course.code and
+        course.curriculum_fingerprint == curriculum_fingerprint
+    ):
+        return False
 
     if cou_code not in course.code:
         course.code = '%s %s' % (course.code, cou_code)
@@ -85,62 +182,304 @@ def collect_class_info(tr, cou_code):
     course.objective = course_dict['object']
     course.prerequisite = course_dict['has_prerequisite']
     course.ge = course_dict['ge_hint'] or ''
+    course.curriculum_fingerprint = curriculum_fingerprint
+    return True
+
+
+def collect_class_info(tr, cou_code):
+    return save_class_info(course_from_tr(tr), cou_code)
+
+
+def save_class_info(course_dict, cou_code):
+    '''
+    course_dict: parsed curriculum row, see crawler.course.course_from_tr
+
+    returns (course, status), status is 'new', 'changed' or 'unchanged';
+    unchanged courses are not written again
+    '''
+    course, create = Course.objects.get_or_create(no=course_dict['no'])
+
+    if not update_class_info(course, course_dict, cou_code) and not create:
+        return course, 'unchanged'
     course.save()
 
-    return create
+    return course, 'new' if create else 'changed'
+
+
+class CourseWriter(object):
+    '''
+    collects parsed curriculum rows and syllabi and writes them in bulk
+
+    Every <batch_size> rows the affected courses are loaded with one query,
+    updated in memory in arrival order (so a course listed under several
+    cou_codes gets all of them in code), then written with one bulk_create
+    for new courses and one bulk_update for changed ones. Call flush() once
+    more when done.
+
+    Work registered with mark_after_flush() is marked in <checkpoint> once
+    everything added before it has been written.
+    '''
+    FIELDS = (
+        'code', 'limit', 'note', 'objective', 'prerequisite', 'ge',
+        'curriculum_fingerprint',
+        'chi_title', 'eng_title', 'credit', 'time', 'time_token', 'teacher',
+        'room', 'syllabus', 'has_attachment', 'ys', 'syllabus_fingerprint',
+    )
+
+    def __init__(self, batch_size=None, report=None, checkpoint=None):
+        self.batch_size = batch_size or BATCH_SIZE
+        self.report = report if report is not None else CrawlReport()
+        self.checkpoint = checkpoint
+        self.rows = []
+        self.marks = []
+
+    def add_class_info(self, course_dict, cou_code):
+        self._add(('curriculum', course_dict['no'], course_dict, cou_code))
+
+    def add_syllabus(self, no, course_dict, ys):
+        self._add(('syllabus', no, course_dict, ys))
+
+    def mark_after_flush(self, *key, **kwargs):
+        '''
+        mark_after_flush(kind, ..., value=None)
+        '''
+        if self.checkpoint is not None:
+            self.marks.append((key, kwargs.get('value')))
+
+    def _add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        rows, self.rows = self.rows, []
+        if rows:
+            self._write(rows)
+        marks, self.marks = self.marks, []
+        for key, value in marks:
+            self.checkpoint.mark(*key, value=value)
+
+    def _write(self, rows):
+        courses = Course.objects.in_bulk(
+            list(set(no for _, no, _, _ in rows)), field_name='no')
+        created = {}
+        changed = {}
+        for kind, no, course_dict, extra in rows:
+            course = courses.get(no)
+            if kind == 'curriculum':
+                if course is None:
+                    course = courses[no] = created[no] = Course(no=no)
+                    self.report.record(no, 'new')
+                updated = update_class_info(course, course_dict, extra)
+            else:
+                if course is None:
+                    print(no, 'has a syllabus but no curriculum row')
+                    continue
+                updated = update_syllabus(course, course_dict, extra)
+            if updated:
+                changed[no] = course
+            self.report.record(no, 'changed' if updated else 'unchanged')
+        Course.objects.bulk_create(
+            list(created.values()), batch_size=self.batch_size)
+        Course.objects.bulk_update(
+            [c for no, c in changed.items() if no not in created],
+            self.FIELDS,
+            batch_size=self.batch_size
+        )
+        update_search_index(list(changed.values()))
+
+
+def update_search_index(courses):
+    '''
+    index written courses in data_center.search_indexes.CourseIndex
+
+    bulk_create / bulk_update send no post_save, so a signal processor never
+    sees courses written by CourseWriter; new and changed ones are indexed
+    here in one backend call, unchanged ones are left alone
+    '''
+    if search_connections is None or not courses:
+        return
+    connection = search_connections['default']
+    try:
+        index = connection.get_unified_index().get_index(Course)
+    except NotHandled:
+        return
+    connection.get_backend().update(index, courses)
 
 
 def handle_curriculum_html(html, cou_code):
+    '''
+    save every course on the curriculum page, returns the courses
+    '''
     cou_code_stripped = cou_code.strip()
-    for tr in curriculum_to_trs(html):
-        collect_class_info(tr, cou_code_stripped)
+    return [
+        collect_class_info(tr, cou_code_stripped)[0]
+        for tr in curriculum_to_trs(html)
+    ]
+
+
+def syllabus_request(no, acixstore, ticket=None):
+    return Request(
+        'get',
+        syllabus_url,
+        context=no,
+        parser=parse_syllabus,
+        ticket=ticket,
+        params={
+            'c_key': no,
+            'ACIXSTORE': acixstore,
+        })
 
 
-def crawl_course(acixstore, auth_num, cou_codes, ys):
-    with FuturesSession(max_workers=MAX_WORKERS) as session:
-        curriculum_futures = [
-            cou_code_2_future(session, cou_code, acixstore, auth_num, ys)
-            for cou_code in cou_codes
-        ]
+def crawl_course(acixstore, auth_num, cou_codes, ys, host_concurrency=None,
+                 parse_workers=None, batch_size=None, checkpoint=None,
+                 refresh_ticket=None):
+    '''
+    crawl curricula of <cou_codes> and the syllabus of every course found
 
-        progress = progressbar.ProgressBar(maxval=len(cou_codes))
-        for future, cou_code in progress(zip(curriculum_futures,
-                                             cou_codes)):
-            response = future.result()
-            response.encoding = 'cp950'
-            # print(response.text)
-
-            handle_curriculum_html(response.text, cou_code)
-
-    print('Crawling syllabus...')
-    course_list = list(Course.objects.all())
-
-    with FuturesSession(max_workers=MAX_WORKERS) as session:
-        course_futures = [
-            session.get(
-                syllabus_url,
-                params={
-                    'c_key': course.no,
-                    'ACIXSTORE': acixstore,
-                }
-            )
-            for course in course_list
-        ]
+    a course's syllabus is requested as soon as its curriculum row is parsed,
+    so the curriculum and syllabus phases overlap; pages are parsed in
+    <parse_workers> processes and written <batch_size> rows at a time
+
+    courses whose curriculum row and syllabus did not change since the last
+    crawl are not written, returns a CrawlReport
 
-        progress = progressbar.ProgressBar(maxval=len(course_list))
-        for future, course in progress(zip_longest(course_futures,
-                                                   course_list)):
-            response = future.result()
-            response.encoding = 'cp950'
-            save_syllabus(response.text, course, ys)
+    with a crawler.checkpoint.Checkpoint, curricula and syllabi already
+    written by an interrupted run are not crawled again
 
-        print('Total course information: %d' % Course.objects.filter(ys=ys).count())  # noqa
+    refresh_ticket() should return a new (acixstore, auth_num) pair, it is
+    called when CCXP ends the session and the failed requests are sent again
+    '''
+    ticket = Ticket(acixstore, auth_num, refresh_ticket)
+    seen = set()
+    writer = CourseWriter(batch_size, checkpoint=checkpoint)
 
+    def done(*key):
+        return checkpoint is not None and checkpoint.done(*key)
 
-def handle_dept_html(html, ys):
+    def syllabus_requests(nos):
+        new_nos = [no for no in nos if no not in seen]
+        seen.update(new_nos)
+        return [
+            syllabus_request(no, acixstore, ticket)
+            for no in new_nos if not done('syllabus', ys, no)
+        ]
+
+    def handle_result(course_dicts, request):
+        if request.url == syllabus_url:
+            writer.add_syllabus(request.context, course_dicts, ys)
+            writer.mark_after_flush('syllabus', ys, request.context)
+            return
+        cou_code = request.context.strip()
+        for course_dict in course_dicts:
+            writer.add_class_info(course_dict, cou_code)
+        nos = [course_dict['no'] for course_dict in course_dicts]
+        writer.mark_after_flush('curriculum', ys, request.context, value=nos)
+        return syllabus_requests(nos)
+
+    requests = [
+        cou_code_2_request(cou_code, acixstore, auth_num, ys, ticket)
+        for cou_code in cou_codes if not done('curriculum', ys, cou_code)
+    ]
+
+    def resumed_syllabus_requests():
+        # syllabi of curricula finished by an interrupted run
+        for key in checkpoint.keys('curriculum'):
+            if key[0] == ys:
+                for request in syllabus_requests(
+                        checkpoint.get('curriculum', *key)):
+                    yield request
+
+    if checkpoint is not None and len(checkpoint):
+        print('Resuming: %d curricula to crawl' % len(requests))
+        requests = itertools.chain(requests, resumed_syllabus_requests())
+
+    engine = CrawlEngine(host_concurrency, parse_workers=parse_workers)
+    try:
+        engine.crawl(requests, handle_result)
+    finally:
+        # rows parsed before an error are written and checkpointed too
+        writer.flush()
+    report = writer.report
+    report.failed = engine.failed
+
+    print('Total course information: %d' % Course.objects.filter(ys=ys).count())  # noqa
+    print('Crawled courses: %s' % report)
+    print('Requests: %s' % format_metrics())
+    return report
+
+
+def crawl_syllabus(acixstore, ys, host_concurrency=None, parse_workers=None,
+                   batch_size=None, checkpoint=None, refresh_ticket=None):
+    '''
+    crawl again the syllabus of every course of ys already in the database
+
+    courses are read from the database lazily while the engine keeps a
+    bounded window of requests in flight, so memory stays flat however many
+    courses there are; arguments are as for crawl_course, returns a
+    CrawlReport
+    '''
+    ticket = Ticket(acixstore, None, refresh_ticket)
+    writer = CourseWriter(batch_size, checkpoint=checkpoint)
+
+    def requests():
+        for course in Course.objects.filter(ys=ys).only('no').iterator():
+            if checkpoint is None or \
+                    not checkpoint.done('syllabus', ys, course.no):
+                yield syllabus_request(course.no, acixstore, ticket)
+
+    def handle_result(course_dict, request):
+        writer.add_syllabus(request.context, course_dict, ys)
+        writer.mark_after_flush('syllabus', ys, request.context)
+
+    engine = CrawlEngine(host_concurrency, parse_workers=parse_workers)
+    try:
+        count = engine.crawl(requests(), handle_result)
+    finally:
+        writer.flush()
+    report = writer.report
+    report.failed = engine.failed
+
+    print('Total syllabi: %d' % count)
+    print('Crawled courses: %s' % report)
+    print('Requests: %s' % format_metrics())
+    return report
+
+
+class CourseNoIndex(object):
+    '''
+    finds courses of one semester by the course number printed on dept pages
+
+    Course numbers look like ``10520EE  152000``, dept pages leave out the
+    ``10520`` semester prefix and may space the rest differently, so courses
+    are indexed by their number without prefix and whitespace.
+    '''
+    def __init__(self, ys):
+        self.prefix = ''.join(ys_2_year_term(ys))
+        self.courses = {}
+        for course in Course.objects.filter(ys=ys).only('no').iterator():
+            self.courses[self.key(course.no)] = course
+
+    def key(self, no):
+        no = re.sub(r'\s', '', no)
+        if no.startswith(self.prefix):
+            no = no[len(self.prefix):]
+        return no
+
+    def get(self, no):
+        return self.courses.get(self.key(no))
+
+
+def dept_from_html(html):
+    '''
+    dept page html -> [(dept_name, [course number, ...])]
+
+    the required courses of every department on the page
+    '''
     soup = bs4.BeautifulSoup(html, "lxml")
     divs = soup.find_all('div', class_='newpage')
 
+    depts = []
     for div in divs:
         # Get something like ``EE  103BA``
         dept_name = div.find_all('font')[0].get_text().strip()
@@ -153,34 +492,53 @@ def handle_dept_html(html, ys):
             continue
 
         trs = div.find_all('tr', bgcolor="#D8DAEB")
+        depts.append(
+            (dept_name, [tr.find_all('td')[0].get_text() for tr in trs]))
+    return depts
+
+
+def handle_dept_html(html, ys, course_index=None):
+    '''
+    link every department on the page to its required courses
+
+    pass a CourseNoIndex of ys when handling many pages of the same semester
+    '''
+    if course_index is None:
+        course_index = CourseNoIndex(ys)
+
+    for dept_name, cou_nos in dept_from_html(html):
         department = Department.objects.get_or_create(
             ys=ys, dept_name=dept_name)[0]
 
-        for tr in trs:
-            tds = tr.find_all('td')
-            cou_no = tds[0].get_text()
-            try:
-                course = Course.objects.get(ys=ys, no__contains=cou_no)
-                department.required_course.add(course)
-                department.save()
-            except:
+        courses = []
+        for cou_no in cou_nos:
+            course = course_index.get(cou_no)
+            if course is None:
                 print(cou_no, 'gg')
+            else:
+                courses.append(course)
+        department.required_course.add(*courses)
 
 
-def crawl_dept(acixstore, auth_num, dept_codes, ys):
-    with FuturesSession(max_workers=MAX_WORKERS) as session:
-        future_depts = [
-            dept_2_future(session, dept_code, acixstore, auth_num, ys)
-            for dept_code in dept_codes
-        ]
+def crawl_dept(acixstore, auth_num, dept_codes, ys, host_concurrency=None,
+               refresh_ticket=None):
+    '''
+    refresh_ticket: see crawl_course
+    '''
+    ticket = Ticket(acixstore, auth_num, refresh_ticket)
+    course_index = CourseNoIndex(ys)
+
+    def handle_dept(response, request):
+        handle_dept_html(response.text, ys, course_index)
 
-        progress = progressbar.ProgressBar()
-        for future in progress(future_depts):
-            response = future.result()
-            response.encoding = encoding
-            handle_dept_html(response.text, ys)
+    CrawlEngine(host_concurrency).crawl(
+        [dept_2_request(dept_code, acixstore, auth_num, ys, ticket)
+         for dept_code in dept_codes],
+        handle_dept
+    )
 
     print('Total department information: %d' % Department.objects.filter(ys=ys).count())  # noqa
+    print('Requests: %s' % format_metrics())
 
 
 def get_token(s):
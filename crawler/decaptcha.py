@@ -1,29 +1,47 @@
 #!/usr/bin/env python3
 
 import logging
+import os
 import re
 import subprocess
 import tempfile
+import threading
+import time
 import io
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 try:
     from urllib.parse import urljoin
 except ImportError:
     from urlparse import urljoin
 
 import lxml.html
+import numpy
 import requests
 # Python Image Library
 from PIL import Image  
 
 try:
-    from utils.config import get_config_section
+    from utils.config import ROOT_DIR, get_config, get_config_section
+    from crawler import transport
 except ImportError:
     captcha_url_base = (
         'https://www.ccxp.nthu.edu.tw/ccxp/INQUIRE/JH/'
         'mod/auth_img/auth_img.php')
+    default_form_url = (
+        'https://www.ccxp.nthu.edu.tw/ccxp/INQUIRE/JH/'
+        '6/6.2/6.2.9/JH629001.php')
+    decaptcha_config = {}
+    ROOT_DIR = os.getcwd()
+    transport = requests
 else:
     decaptcha_config = get_config_section('decaptcha')
     captcha_url_base = decaptcha_config['captcha_url_base']
+    default_form_url = get_config('crawler', 'form_url')
 
 logger = logging.getLogger(__name__)
 
@@ -48,20 +66,187 @@ def tesseract_versions():
     )
 
 
-def preprocess(b):
-    color = Image.open(io.BytesIO(b))
-    gray = color.convert('L')
-    bw = gray.point(lambda c: (c > 150) * 255, '1')
-    fp = io.BytesIO()
-    bw.save(fp, 'png')
-    return fp.getvalue()
+def denoise(ink):
+    '''
+    clear ink pixels without any inked neighbour, works on a single
+    (height, width) mask or a (count, height, width) batch
+    '''
+    padded = numpy.pad(
+        ink, [(0, 0)] * (ink.ndim - 2) + [(1, 1), (1, 1)], 'constant')
+    height, width = ink.shape[-2:]
+    neighbours = sum(
+        padded[..., 1 + dy:1 + dy + height, 1 + dx:1 + dx + width]
+        for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+        if dy or dx
+    )
+    return ink & (neighbours > 0)
+
+
+def gray_array(b):
+    return numpy.asarray(Image.open(io.BytesIO(b)).convert('L'))
+
+
+def binarize(b, threshold=150):
+    '''
+    captcha image bytes -> boolean ink mask of shape (height, width), True
+    where the pixel is not brighter than threshold, without ink pixels that
+    have no inked neighbour; every recogniser, tesseract too, sees it so
+    '''
+    return denoise(gray_array(b) <= threshold)
+
+
+def binarize_batch(bs, threshold=150):
+    '''
+    binarize many captchas, images of the same size are done in one go
+    '''
+    grays = [gray_array(b) for b in bs]
+    if not grays or len(set(g.shape for g in grays)) > 1:
+        return [denoise(g <= threshold) for g in grays]
+    return list(denoise(numpy.stack(grays) <= threshold))
+
+
+def ink_to_image(ink):
+    return Image.fromarray(numpy.where(ink, 0, 255).astype(numpy.uint8))
+
+
+def segment(ink):
+    '''
+    ink mask -> list of ink masks of every digit, left to right
+
+    digits are separated by columns without ink and cropped to their ink
+    '''
+    columns = numpy.concatenate(([False], ink.any(axis=0), [False]))
+    edges = numpy.flatnonzero(columns[1:] != columns[:-1])
+    digits = []
+    for start, stop in zip(edges[::2], edges[1::2]):
+        digit = ink[:, start:stop]
+        rows = numpy.flatnonzero(digit.any(axis=1))
+        digits.append(digit[rows[0]:rows[-1] + 1])
+    return digits
+
+
+class Recogniser(object):
+    '''
+    reads the digits of a captcha
+
+    recognise() takes the ink mask from binarize and returns the digits as
+    bytes, b'' if it cannot tell
+    '''
+    def recognise(self, ink):
+        raise NotImplementedError
+
+
+class TesseractRecogniser(Recogniser):
+    '''
+    runs the tesseract binary on every captcha
+    '''
+    def recognise(self, ink):
+        with tempfile.NamedTemporaryFile(suffix='.png') as tmpimg:
+            ink_to_image(ink).save(tmpimg, 'png')
+            tmpimg.flush()
+            return tesseract(tmpimg.name).replace(b' ', b'')
+
+
+def labelled_samples(path):
+    '''
+    yields (image bytes, label) for every captcha image in directory path
+
+    images are named after their digits, optionally followed by _anything,
+    e.g. 123.png, 123_2.png
+    '''
+    for filename in sorted(os.listdir(path)):
+        label = os.path.splitext(filename)[0].split('_')[0]
+        if not label.isdigit():
+            continue
+        with open(os.path.join(path, filename), 'rb') as f:
+            yield f.read(), label
+
+
+class TemplateRecogniser(Recogniser):
+    '''
+    nearest neighbour digit classifier, no external process involved
+
+    A captcha is cut into digits at blank columns, every digit is scaled to
+    <size> and compared pixel by pixel with the digits of labelled samples
+    given to train().
+    '''
+    size = (16, 12)  # height, width
+
+    def __init__(self, samples=(), threshold=150):
+        self.threshold = threshold
+        self.templates = numpy.zeros((0, self.size[0] * self.size[1]), bool)
+        self.labels = []
+        self.train(samples)
+
+    def features(self, digits):
+        '''
+        digit masks -> (len(digits), height * width) array, every digit
+        scaled to <size> by nearest neighbour
+        '''
+        height, width = self.size
+        features = numpy.zeros((len(digits), height * width), bool)
+        for i, digit in enumerate(digits):
+            rows = numpy.arange(height) * digit.shape[0] // height
+            columns = numpy.arange(width) * digit.shape[1] // width
+            features[i] = digit[rows[:, None], columns].ravel()
+        return features
+
+    def train(self, samples):
+        '''
+        samples: iterable of (image bytes, label)
+        '''
+        samples = list(samples)
+        inks = binarize_batch([b for b, label in samples], self.threshold)
+        digits = []
+        for ink, (b, label) in zip(inks, samples):
+            sample_digits = segment(ink)
+            if len(sample_digits) != len(label):
+                logger.info('%r: cannot cut into %d digits', label, len(label))
+                continue
+            digits.extend(sample_digits)
+            self.labels.extend(label)
+        self.templates = numpy.concatenate(
+            (self.templates, self.features(digits)))
+
+    def classify(self, digits):
+        '''
+        digit masks -> string of their nearest templates' labels
+        '''
+        distances = (
+            self.features(digits)[:, None, :] != self.templates[None, :, :]
+        ).sum(axis=2)
+        return ''.join(self.labels[i] for i in distances.argmin(axis=1))
+
+    def recognise(self, ink):
+        digits = segment(ink)
+        if not self.labels or not digits:
+            return b''
+        return self.classify(digits).encode('ascii')
+
+
+class FallbackRecogniser(Recogniser):
+    '''
+    asks <recognisers> in order until one returns <length> digits
+    '''
+    def __init__(self, recognisers, length=None):
+        self.recognisers = recognisers
+        self.length = length
+
+    def recognise(self, ink):
+        result = b''
+        for recogniser in self.recognisers:
+            result = recogniser.recognise(ink)
+            if result.isdigit() and (
+                self.length is None or len(result) == self.length
+            ):
+                return result
+        return result
 
 
-def decaptcha_url(url, params=None):
-    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmpimg:
-        tmpimg.write(preprocess(requests.get(url, params=params).content))
-        tmpimg.flush()
-        return tesseract(tmpimg.name).replace(b' ', b'')
+def decaptcha_url(url, params=None, recogniser=None):
+    recogniser = recogniser or get_default_recogniser()
+    return recogniser.recognise(
+        binarize(transport.get(url, params=params).content))
 
 
 class Entrance(object):
@@ -70,9 +255,11 @@ class Entrance(object):
         form_url,
         form_action_url=None,
         page_encoding='cp950',
-        captcha_length_hint=3
+        captcha_length_hint=3,
+        recogniser=None
     ):
         self.form_url = form_url
+        self.recogniser = recogniser
         self.form_action_url = form_action_url
         if form_action_url is None:
             self.form_action_url = None
@@ -98,7 +285,7 @@ class Entrance(object):
             self._form_action_url = val
 
     def get_key_from_new_form(self, xpath_hint):
-        response = requests.get(self.form_url)
+        response = transport.get(self.form_url)
         response.encoding = self.page_encoding
         document = lxml.html.fromstring(response.text)
         return document.xpath(xpath_hint)[0].value
@@ -107,7 +294,7 @@ class Entrance(object):
         return self.get_key_from_new_form('//input[@name="ACIXSTORE"]')
 
     def guess_form_action_url(self):
-        response = requests.get(self.form_url)
+        response = transport.get(self.form_url)
         response.encoding = self.page_encoding
         document = lxml.html.fromstring(response.text, base_url=self.form_url)
         element = document.xpath('//input[@type="submit"]')[0]
@@ -119,7 +306,7 @@ class Entrance(object):
 
     def validate_by_post(self, result):
         acixstore, captcha = result
-        response = requests.post(
+        response = transport.post(
             self.form_action_url,
             data={
                 'ACIXSTORE': acixstore,
@@ -167,7 +354,8 @@ class Entrance(object):
         acixstore = self.get_acixstore()
         captcha = decaptcha_url(
             captcha_url_base,
-            params={'ACIXSTORE': acixstore}
+            params={'ACIXSTORE': acixstore},
+            recogniser=self.recogniser
         )
         return acixstore, captcha
 
@@ -185,6 +373,110 @@ class Entrance(object):
 
 
 
+class TicketPool(object):
+    '''
+    solves captchas in the background and keeps validated tickets ready
+
+    For every form url asked for, up to <size> (acixstore, captcha) pairs are
+    kept queued or being solved by a pool of <workers> threads, so
+    get_ticket usually returns at once. Tickets older than <max_age> seconds
+    are thrown away. get_ticket raises DecaptchaFailure after <retries>
+    failed attempts in a row, or once the pool is shut down.
+    '''
+    # queued after shutdown to wake up get_ticket
+    CLOSED = object()
+
+    def __init__(self, size=None, workers=None, retries=32, max_age=600,
+                 recogniser=None):
+        self.size = size or int(decaptcha_config.get('ticket_pool_size', 2))
+        self.retries = retries
+        self.max_age = max_age
+        self.recogniser = recogniser
+        self._executor = ThreadPoolExecutor(
+            workers or int(decaptcha_config.get('ticket_workers', 4)))
+        self._lock = threading.Lock()
+        self._entrances = {}
+        self._tickets = defaultdict(queue.Queue)
+        self._solving = defaultdict(int)
+        self._failures = defaultdict(int)
+        self._closed = False
+
+    def entrance(self, form_url):
+        with self._lock:
+            if form_url not in self._entrances:
+                self._entrances[form_url] = Entrance(
+                    form_url, recogniser=self.recogniser)
+            return self._entrances[form_url]
+
+    def prefetch(self, form_url):
+        '''
+        start solving captchas for form_url until <size> tickets are ready
+        '''
+        with self._lock:
+            if self._closed:
+                return
+            missing = (
+                self.size -
+                self._tickets[form_url].qsize() -
+                self._solving[form_url]
+            )
+            for try_ in range(missing):
+                self._solving[form_url] += 1
+                self._executor.submit(self._solve, form_url)
+
+    def _solve(self, form_url):
+        try:
+            entrance = self.entrance(form_url)
+            result = entrance._get_ticket()
+            correct = entrance.validate(result)
+        except Exception:
+            logger.exception('cannot get a ticket for %r', form_url)
+            correct = False
+        with self._lock:
+            self._solving[form_url] -= 1
+            if correct:
+                self._failures[form_url] = 0
+                self._tickets[form_url].put((time.time(), result))
+                return
+            self._failures[form_url] += 1
+            if self._failures[form_url] >= self.retries:
+                self._failures[form_url] = 0
+                self._tickets[form_url].put((time.time(), None))
+                return
+        self.prefetch(form_url)
+
+    def get_ticket(self, form_url):
+        '''
+        returns (acixstore, captcha) pair
+        raises DecaptchaFailure if cannot guess captcha in limited retries,
+        or if the pool is shut down
+        '''
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise DecaptchaFailure('Ticket pool is shut down')
+                tickets = self._tickets[form_url]
+            self.prefetch(form_url)
+            created, result = tickets.get()
+            if result is self.CLOSED:
+                tickets.put((created, result))  # for other waiters
+                raise DecaptchaFailure('Ticket pool is shut down')
+            if result is None:
+                raise DecaptchaFailure(
+                    'Cannot decaptcha for, retries=%i' % self.retries)
+            if time.time() - created <= self.max_age:
+                self.prefetch(form_url)
+                return result
+            logger.info('%r: ticket expired, dropped', form_url)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            for tickets in self._tickets.values():
+                tickets.put((time.time(), self.CLOSED))
+        self._executor.shutdown(wait=False)
+
+
 def benchmark(ent, count):
     correct_count = 0
     for try_ in range(count):
@@ -199,11 +491,95 @@ def benchmark(ent, count):
     )
 
 
+def percentile(sorted_values, p):
+    index = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def benchmark_offline(samples, recogniser, threshold=150):
+    '''
+    run binarize + recogniser over labelled samples, no network involved
+
+    returns a dict of accuracy, latency percentiles (seconds) and throughput
+    (captchas per second)
+    '''
+    correct_count = 0
+    latencies = []
+    for b, label in samples:
+        start = time.perf_counter()
+        result = recogniser.recognise(binarize(b, threshold))
+        latencies.append(time.perf_counter() - start)
+        correct_count += result == label.encode('ascii')
+    if not latencies:
+        raise ValueError('no labelled samples')
+    latencies.sort()
+    return {
+        'count': len(latencies),
+        'accuracy': float(correct_count) / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'throughput': len(latencies) / sum(latencies),
+    }
+
+
+RECOGNISERS = ('template', 'tesseract')
+
+
+def skip_reason(name, train_samples):
+    '''
+    why recogniser <name> cannot be benchmarked, None if it can
+    '''
+    if name == 'tesseract' and tesseract_error is not None:
+        return 'tesseract >= 3.03 not installed'
+    if name == 'template' and not train_samples:
+        return 'no template corpus'
+    return None
+
+
+def print_offline_benchmark(corpus, train_corpus, recognisers, thresholds):
+    '''
+    compare every recogniser at every threshold on the images in corpus
+
+    the template recogniser is trained on train_corpus at the same threshold;
+    recognisers None means all of RECOGNISERS; only those that can run here
+    are benchmarked, the others are listed as skipped with the reason
+    '''
+    samples = list(labelled_samples(corpus))
+    train_samples = list(labelled_samples(train_corpus)) if train_corpus else []
+    print('{:<10} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'recogniser', 'threshold', 'accuracy',
+        'p50 ms', 'p90 ms', 'p99 ms', 'per sec'))
+    for name in recognisers or RECOGNISERS:
+        reason = skip_reason(name, train_samples)
+        if reason is not None:
+            print('{:<10} skipped: {}'.format(name, reason))
+            continue
+        for threshold in thresholds:
+            if name == 'template':
+                recogniser = TemplateRecogniser(train_samples, threshold)
+                if not recogniser.labels:
+                    print('{:<10} {:>9} skipped: no template corpus sample '
+                          'cuts into its digits'.format(name, threshold))
+                    continue
+            else:
+                recogniser = TesseractRecogniser()
+            result = benchmark_offline(samples, recogniser, threshold)
+            print(
+                '{:<10} {:>9} {:>9.2%} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.1f}'
+                .format(
+                    name, threshold, result['accuracy'],
+                    result['p50'] * 1000, result['p90'] * 1000,
+                    result['p99'] * 1000, result['throughput']
+                )
+            )
+
+
 # tesseract availability test
 try:
     versions = tesseract_versions()
 except (subprocess.CalledProcessError, OSError):
-    raise ImportError('%r requires tesseract binary' % __name__)
+    tesseract_error = '%r requires tesseract binary' % __name__
 else:
     major, minor = list(map(
         int,
@@ -214,7 +590,48 @@ else:
     #  leptonica-1.72
     #   libgif 5.1.1 : libjpeg 8d (libjpeg-turbo 1.4.1)...
     if (major, minor) < (3, 3):
-        raise ImportError('%r requires tesseract >= 3.03' % __name__)
+        tesseract_error = '%r requires tesseract >= 3.03' % __name__
+    else:
+        tesseract_error = None
+
+
+def build_recogniser(corpus=None, use_tesseract=False):
+    '''
+    template recogniser trained on the labelled captchas in directory corpus
+    if given, then tesseract if use_tesseract, reading 3 digits
+    raises DecaptchaFailure if that leaves no recogniser
+    '''
+    recognisers = []
+    if corpus:
+        recognisers.append(TemplateRecogniser(labelled_samples(corpus)))
+    if use_tesseract:
+        recognisers.append(TesseractRecogniser())
+    if not recognisers:
+        raise DecaptchaFailure(
+            'No captcha recogniser: configure a template_corpus or install '
+            'tesseract >= 3.03')
+    return FallbackRecogniser(recognisers, length=3)
+
+
+_default_recogniser = None
+_default_recogniser_lock = threading.Lock()
+
+
+def get_default_recogniser():
+    '''
+    template recogniser trained on the template_corpus directory if
+    configured, with tesseract as fallback
+
+    built on first use, so the module imports without either
+    '''
+    global _default_recogniser
+    with _default_recogniser_lock:
+        if _default_recogniser is None:
+            corpus = decaptcha_config.get('template_corpus')
+            _default_recogniser = build_recogniser(
+                corpus and os.path.join(ROOT_DIR, corpus),
+                tesseract_error is None)
+        return _default_recogniser
 
 
 if __name__ == '__main__':
@@ -227,7 +644,7 @@ if __name__ == '__main__':
     parser.add_argument(
         '--form-url',
         help='target form url',
-        default='https://www.ccxp.nthu.edu.tw/ccxp/INQUIRE/JH/6/6.2/6.2.9/JH629001.php',  # noqa
+        default=default_form_url,
     )
     parser.add_argument(
         '--form-action-url',
@@ -252,6 +669,30 @@ if __name__ == '__main__':
         help='test correct rate',
         metavar='COUNT'
     )
+    parser.add_argument(
+        '--corpus',
+        help='benchmark offline on this directory of labelled captchas '
+             '(e.g. 123.png) instead of the live site',
+        default=None
+    )
+    parser.add_argument(
+        '--train-corpus',
+        help='labelled captchas to train the template recogniser '
+             '(template_corpus in config by default)',
+        default=None
+    )
+    parser.add_argument(
+        '--recogniser',
+        help='recogniser to benchmark offline, may be repeated',
+        choices=RECOGNISERS,
+        action='append'
+    )
+    parser.add_argument(
+        '--threshold',
+        help='binarize threshold to benchmark offline, may be repeated',
+        type=int,
+        action='append'
+    )
 
     args = parser.parse_args()
 
@@ -259,6 +700,19 @@ if __name__ == '__main__':
         logger.setLevel(logging.INFO)
         logger.addHandler(logging.StreamHandler())
 
+    if args.corpus:
+        train_corpus = args.train_corpus
+        if train_corpus is None and decaptcha_config.get('template_corpus'):
+            train_corpus = os.path.join(
+                ROOT_DIR, decaptcha_config['template_corpus'])
+        print_offline_benchmark(
+            args.corpus,
+            train_corpus,
+            args.recogniser,
+            args.threshold or [150]
+        )
+        raise SystemExit
+
     ent = Entrance(
         args.form_url,
         args.form_action_url
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+from crawler.course import get, post, crawler_config, SessionExpired
+from crawler.ratelimit import count, get_controller
+
+logger = logging.getLogger(__name__)
+
+HOST_CONCURRENCY = int(crawler_config.get('host_concurrency', 8))
+PARSE_WORKERS = int(crawler_config.get('parse_workers', os.cpu_count() or 1))
+WINDOW = int(crawler_config.get('window', 64))
+
+request_functions = {
+    'get': get,
+    'post': post,
+}
+
+# result of a request that could not be fetched or parsed
+FAILED = object()
+
+# parse workers start while fetch threads may hold locks (logging, urllib3
+# pools), a child forked from this process could inherit one held forever;
+# forkserver children are forked from a clean single-threaded server instead
+PARSE_CONTEXT = (
+    multiprocessing.get_context('forkserver')
+    if 'forkserver' in multiprocessing.get_all_start_methods() else None
+)
+
+
+class Request(object):
+    '''
+    a pending http request
+
+    method      'get' or 'post'
+    url         target url
+    context     anything the handler needs to know about this request
+    parser      picklable function: response body bytes -> parsed result,
+                the handler gets its result instead of the response
+    ticket      crawler.course.Ticket, its current pair replaces ACIXSTORE
+                and auth_num in params / data when the request is sent
+    kwargs      passed to crawler.course.get / post
+    '''
+    def __init__(self, method, url, context=None, parser=None, ticket=None,
+                 **kwargs):
+        self.method = method
+        self.url = url
+        self.context = context
+        self.parser = parser
+        self.ticket = ticket
+        self.kwargs = kwargs
+
+    @property
+    def host(self):
+        return urlsplit(self.url).netloc
+
+    def ticketed_kwargs(self):
+        '''
+        returns (kwargs to send, acixstore they use)
+        '''
+        if self.ticket is None:
+            return self.kwargs, None
+        acixstore, auth_num = self.ticket.acixstore, self.ticket.auth_num
+        kwargs = dict(self.kwargs)
+        for name in ('params', 'data'):
+            if name in kwargs:
+                fields = kwargs[name] = dict(kwargs[name])
+                if 'ACIXSTORE' in fields:
+                    fields['ACIXSTORE'] = acixstore
+                if 'auth_num' in fields:
+                    fields['auth_num'] = auth_num
+        return kwargs, acixstore
+
+    def __repr__(self):
+        return '<Request %s %s %r>' % (self.method, self.url, self.context)
+
+
+class HostGate(object):
+    '''
+    async context manager letting at most controller.limit tasks in at once,
+    the limit is re-read whenever a task leaves
+    '''
+    def __init__(self, controller):
+        self.controller = controller
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(
+                lambda: self.active < self.controller.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+
+class CrawlEngine(object):
+    '''
+    asyncio driver for CCXP requests
+
+    The blocking request functions from crawler.course run in a thread pool.
+    Requests that carry a ticket survive session expiry, see fetch().
+    Every host has its own gate, so at most <host_concurrency> requests are
+    in flight per host, fewer while the host's AIMDController is backing off
+    because of errors or slow responses. Responses of requests with a parser are parsed in
+    a pool of <parse_workers> processes (inline if 0) while other requests
+    are still downloading. Handlers are called in the event loop thread in
+    the order responses finish, not the order requests were made.
+
+    Requests are taken from their iterables only while fewer than <window>
+    are unfinished, so a lazy iterable is never read far ahead and at most
+    <window> responses are held at once, whatever the number of requests.
+    '''
+    def __init__(self, host_concurrency=None, max_workers=None,
+                 parse_workers=None, window=None):
+        self.host_concurrency = host_concurrency or HOST_CONCURRENCY
+        self.max_workers = max_workers or self.host_concurrency * 2
+        if parse_workers is None:
+            parse_workers = PARSE_WORKERS
+        self.parse_workers = parse_workers
+        self.window = max(window or WINDOW, self.host_concurrency)
+        # requests skipped by the last crawl()
+        self.failed = 0
+        self._gates = None
+        self._executor = None
+        self._parse_executor = None
+
+    def _gate(self, host):
+        if host not in self._gates:
+            self._gates[host] = HostGate(
+                get_controller(host, self.host_concurrency))
+        return self._gates[host]
+
+    async def fetch(self, request, session_retries=3):
+        '''
+        if the session expires, the request's ticket is renewed and the
+        request sent again with the new one, up to <session_retries> times
+        '''
+        loop = asyncio.get_event_loop()
+        for try_ in range(session_retries + 1):
+            kwargs, acixstore = request.ticketed_kwargs()
+            request_function = functools.partial(
+                request_functions[request.method],
+                request.url,
+                **kwargs
+            )
+            async with self._gate(request.host):
+                logger.debug('fetching %r', request)
+                try:
+                    return await loop.run_in_executor(
+                        self._executor, request_function)
+                except SessionExpired:
+                    if request.ticket is None or try_ == session_retries:
+                        raise
+            await loop.run_in_executor(
+                self._executor, request.ticket.renew, acixstore)
+
+    async def parse(self, request, response):
+        if request.parser is None:
+            return response
+        if not self.parse_workers:
+            return request.parser(response.content)
+        if self._parse_executor is None:
+            self._parse_executor = ProcessPoolExecutor(
+                self.parse_workers, mp_context=PARSE_CONTEXT)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._parse_executor, request.parser, response.content)
+
+    async def _crawl(self, requests, handler):
+        self._gates = {}
+        self.failed = 0
+
+        async def fetch(request):
+            try:
+                response = await self.fetch(request)
+            except Exception:
+                count('fetch_failures')
+                print(traceback.format_exc())
+                print(request)
+                return request, FAILED
+            try:
+                return request, await self.parse(request, response)
+            except Exception:
+                count('parse_failures')
+                print(traceback.format_exc())
+                print(request)
+                return request, FAILED
+
+        def schedule(requests):
+            if requests:
+                # requests returned by a handler go first, so the pages one
+                # response leads to are done before more are taken
+                sources.appendleft(iter(requests))
+
+        def fill():
+            while sources and len(pending) < self.window:
+                request = next(sources[0], None)
+                if request is None:
+                    sources.popleft()
+                    continue
+                pending.add(asyncio.ensure_future(fetch(request)))
+
+        sources = deque()
+        pending = set()
+        done_count = 0
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._executor = executor
+        try:
+            schedule(requests)
+            fill()
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    request, result = task.result()
+                    if result is FAILED:
+                        self.failed += 1
+                        continue
+                    schedule(handler(result, request))
+                    done_count += 1
+                    logger.info(
+                        '%d done, %d in flight %r',
+                        done_count, len(pending), request)
+                # only once the finished responses are handled and released
+                fill()
+        finally:
+            for task in pending:
+                task.cancel()
+            executor.shutdown(wait=True)
+            self._executor = None
+            if self._parse_executor is not None:
+                self._parse_executor.shutdown()
+                self._parse_executor = None
+        return done_count
+
+    def crawl(self, requests, handler):
+        '''
+        fetch every request and call handler(result, request) as soon as
+        each response arrives, where result is the parsed response if the
+        request has a parser, else the response itself; requests that
+        cannot be fetched (after retries and ticket renewals) or parsed are
+        reported, counted as fetch_failures / parse_failures and skipped,
+        how many is kept in .failed
+
+        requests and what handler returns may be any iterable, including
+        generators; handler may return more requests, they are fetched in
+        the same run, which lets one phase feed the next without waiting for
+        it to finish
+
+        returns the number of handled responses
+        '''
+        return asyncio.run(self._crawl(requests, handler))
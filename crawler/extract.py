@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+try:
+    import textract
+except ImportError:
+    textract = None
+
+from utils.config import ROOT_DIR, get_config_section
+from crawler.ratelimit import count
+
+logger = logging.getLogger(__name__)
+
+extract_config = get_config_section('extract')
+
+WORKERS = int(extract_config.get('workers') or os.cpu_count() or 1)
+CACHE_PATH = os.path.join(
+    ROOT_DIR, extract_config.get('path') or 'cache/text')
+
+# the pool starts on a download thread while others are running, see
+# crawler.engine.PARSE_CONTEXT
+EXTRACT_CONTEXT = (
+    multiprocessing.get_context('forkserver')
+    if 'forkserver' in multiprocessing.get_all_start_methods() else None
+)
+
+
+class ExtractionError(Exception):
+    def __init__(self, path, message):
+        super(ExtractionError, self).__init__(path, message)
+        self.path = path
+        self.message = message
+
+    def __str__(self):
+        return '%s: %s' % (self.path, self.message)
+
+
+def file_digest(path, chunk_size=1 << 16):
+    '''
+    sha1 of the file's content, the key of its extracted text
+    '''
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def extract_pdf(path, cache_path, digest):
+    '''
+    text of the pdf at path, stored in the cache as <digest>.txt; runs in a
+    worker process
+
+    The reason a pdf could not be read goes to <digest>.error instead, and
+    is raised as ExtractionError. It is not reused, the next run tries again.
+    '''
+    entry = os.path.join(cache_path, digest[:2], digest)
+    try:
+        if textract is None:
+            raise ImportError('textract is not installed')
+        text = textract.process(path).decode('utf-8')
+    except Exception as e:
+        message = '%s: %s' % (type(e).__name__, e)
+        _write_atomic(entry + '.error', '%s\n%s\n' % (path, message))
+        raise ExtractionError(path, message)
+    _write_atomic(entry + '.txt', text)
+    if os.path.exists(entry + '.error'):
+        os.remove(entry + '.error')
+    return text
+
+
+def cached_text(cache_path, digest):
+    '''
+    cached text of the pdf with this digest, None if not extracted yet
+    '''
+    entry = os.path.join(cache_path, digest[:2], digest + '.txt')
+    try:
+        with open(entry, encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def read_text(path, cache_path):
+    '''
+    text of a downloaded syllabus file, through the cache for pdfs
+    raises ExtractionError
+    '''
+    if not path.endswith('.pdf'):
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    digest = file_digest(path)
+    text = cached_text(cache_path, digest)
+    if text is None:
+        text = extract_pdf(path, cache_path, digest)
+    return text
+
+
+class TextExtractor(object):
+    '''
+    text of downloaded syllabi, pdfs are extracted by textract in <workers>
+    processes
+
+    Extracted text is cached under <cache_path> by the pdf's content hash,
+    so analysing the same files again, e.g. with other keywords, never runs
+    textract twice. Failed extractions raise ExtractionError from the
+    future and are kept in .failures as (path, message).
+    '''
+    def __init__(self, workers=None, cache_path=None):
+        self.workers = workers or WORKERS
+        self.cache_path = cache_path or CACHE_PATH
+        self.failures = []
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, path):
+        '''
+        returns a Future of the file's text
+        '''
+        future = Future()
+        if not path.endswith('.pdf'):
+            with open(path, encoding='utf-8') as f:
+                future.set_result(f.read())
+            return future
+        digest = file_digest(path)
+        text = cached_text(self.cache_path, digest)
+        if text is not None:
+            count('extract_cached')
+            future.set_result(text)
+            return future
+        count('extract')
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=EXTRACT_CONTEXT)
+        self._executor.submit(
+            extract_pdf, path, self.cache_path, digest
+        ).add_done_callback(lambda done: self._resolve(done, future))
+        return future
+
+    def _resolve(self, done, future):
+        '''
+        record a failure before anyone waiting on future sees it
+        '''
+        error = done.exception()
+        if error is None:
+            future.set_result(done.result())
+            return
+        if isinstance(error, ExtractionError):
+            count('extract_failures')
+            logger.warning('%s', error)
+            with self._lock:
+                self.failures.append((error.path, error.message))
+        future.set_exception(error)
+
+    def text(self, path):
+        '''
+        the file's text, raises ExtractionError
+        '''
+        return self.submit(path).result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import logging
+import random
+import threading
+import time
+from collections import Counter
+
+from utils.config import get_config_section
+
+logger = logging.getLogger(__name__)
+
+ratelimit_config = get_config_section('ratelimit')
+
+BACKOFF_BASE = float(ratelimit_config.get('backoff_base', 0.5))
+BACKOFF_CAP = float(ratelimit_config.get('backoff_cap', 30))
+LATENCY_TARGET = float(ratelimit_config.get('latency_target', 5))
+HOST_CONCURRENCY = int(
+    get_config_section('crawler').get('host_concurrency', 8))
+
+# request counters: requests, retries, empty, server_errors, timeouts,
+# errors (other connection errors), throttled
+metrics = Counter()
+_metrics_lock = threading.Lock()
+
+
+def count(name, n=1):
+    with _metrics_lock:
+        metrics[name] += n
+
+
+def format_metrics():
+    with _metrics_lock:
+        return ', '.join(
+            '%s: %d' % (name, metrics[name]) for name in sorted(metrics))
+
+
+class Backoff(object):
+    '''
+    jittered exponential backoff: the n-th retry waits a random time between
+    0 and min(cap, base * 2 ** n) seconds
+    '''
+    def __init__(self, base=None, cap=None):
+        self.base = BACKOFF_BASE if base is None else base
+        self.cap = BACKOFF_CAP if cap is None else cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def sleep(self, attempt):
+        time.sleep(self.delay(attempt))
+
+
+class AIMDController(object):
+    '''
+    concurrency limit for one host, adjusted like TCP congestion control
+
+    Every good response raises the limit by 1 / limit (about +1 per round of
+    requests) up to <maximum>. A failed or slower than <latency_target>
+    response halves it, at most once per <latency_target> seconds so a
+    burst of failures counts as one, but never below <minimum>.
+    '''
+    def __init__(self, maximum, minimum=1, latency_target=None):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.latency_target = latency_target or LATENCY_TARGET
+        self._limit = float(maximum)
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return min(int(self._limit), self.maximum)
+
+    def record(self, latency, ok):
+        with self._lock:
+            if ok and latency <= self.latency_target:
+                self._limit = min(
+                    self.maximum, self._limit + 1.0 / self._limit)
+                return
+            now = time.time()
+            if now - self._last_decrease < self.latency_target:
+                return
+            self._last_decrease = now
+            self._limit = max(self.minimum, self._limit / 2)
+        count('throttled')
+        logger.info('backing off to %d concurrent requests', self.limit)
+
+
+class HostSlots(object):
+    '''
+    context manager letting at most controller.limit threads in at once
+
+    Every request a thread sends to the host takes a slot, whichever module
+    sends it (crawler.course.get / post, attachment downloads), so they all
+    share the host's adaptive limit; see crawler.engine.HostGate for the
+    asyncio side.
+    '''
+    def __init__(self, controller):
+        self.controller = controller
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.active < self.controller.limit)
+            self.active += 1
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+
+_controllers = {}
+_slots = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(host, maximum=None):
+    '''
+    the AIMDController of host, its maximum is set to <maximum> if given,
+    host_concurrency from the config on creation otherwise
+    '''
+    with _controllers_lock:
+        controller = _controllers.get(host)
+        if controller is None:
+            controller = _controllers[host] = AIMDController(
+                maximum or HOST_CONCURRENCY)
+        elif maximum is not None:
+            controller.maximum = maximum
+        return controller
+
+
+def host_slot(host):
+    '''
+    the HostSlots of host, to hold while a request to it is in flight
+    '''
+    controller = get_controller(host)
+    with _controllers_lock:
+        slots = _slots.get(host)
+        if slots is None:
+            slots = _slots[host] = HostSlots(controller)
+        return slots
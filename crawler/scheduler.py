@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import threading
+import time
+import traceback
+
+from utils.config import get_config_section
+
+logger = logging.getLogger(__name__)
+
+scheduler_config = get_config_section('scheduler')
+
+WORKERS = int(scheduler_config.get('workers', 8))
+PROGRESS_INTERVAL = float(scheduler_config.get('progress_interval', 30))
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Progress(object):
+    '''
+    done / total counter with rate and ETA, total grows as work is discovered
+    '''
+    def __init__(self):
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, n=1):
+        with self._lock:
+            self.total += n
+
+    def finish(self, ok=True):
+        with self._lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+
+    def eta(self):
+        '''
+        seconds until the known work is done, None before anything finished
+        '''
+        elapsed = time.time() - self.start
+        if not self.done or not elapsed:
+            return None
+        return (self.total - self.done) / (self.done / elapsed)
+
+    def __str__(self):
+        with self._lock:
+            done, total, failed = self.done, self.total, self.failed
+        elapsed = time.time() - self.start
+        eta = self.eta()
+        return '%d/%d tasks (%d failed), %.1f/s, elapsed %s, eta %s' % (
+            done, total, failed,
+            done / elapsed if elapsed else 0,
+            format_duration(elapsed),
+            '?' if eta is None else format_duration(eta),
+        )
+
+
+class Scheduler(object):
+    '''
+    work queue run by <workers> threads
+
+    Tasks are plain functions, a running task may submit() more of them
+    (a semester's curricula, then each curriculum's syllabi), so the whole
+    semester x department x course space is worked through at once instead
+    of one request after the other. A failing task is printed and counted,
+    the others go on. run() blocks until the queue is empty, printing
+    Progress every <progress_interval> seconds.
+
+    The workers bound the tasks in progress, not the requests: whatever a
+    task sends to a host, attachment downloads included, waits for a slot
+    of that host's AIMDController (crawler.ratelimit.host_slot).
+    '''
+    def __init__(self, workers=None, progress_interval=None):
+        self.workers = workers or WORKERS
+        self.progress_interval = (
+            PROGRESS_INTERVAL if progress_interval is None
+            else progress_interval
+        )
+        self.progress = Progress()
+        self._queue = queue.Queue()
+
+    def submit(self, function, *args, **kwargs):
+        self.progress.add()
+        self._queue.put((function, args, kwargs))
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            function, args, kwargs = task
+            ok = True
+            try:
+                function(*args, **kwargs)
+            except Exception:
+                ok = False
+                print('Task %s%r failed:' % (function.__name__, args))
+                traceback.print_exc()
+            self.progress.finish(ok)
+            self._queue.task_done()
+
+    def _report(self, stop):
+        while not stop.wait(self.progress_interval):
+            print(self.progress)
+
+    def run(self):
+        '''
+        returns the Progress once every submitted task is done
+        '''
+        self.progress.start = time.time()
+        threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        stop = threading.Event()
+        if self.progress_interval:
+            threading.Thread(
+                target=self._report, args=(stop,), daemon=True).start()
+        self._queue.join()
+        stop.set()
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        print(self.progress)
+        return self.progress
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+
+'''
+local stand-in for CCXP, to run the crawler offline
+
+    python -m crawler.simulator [--port 8000] [--latency 0.1]
+        [--error-rate 0.01] [--session-ttl 600] [--write-config simulator.cfg]
+
+Every url of config/nthu_course.cfg is served on its own path: the course
+and dept captcha forms, the captcha images, curricula, syllabi, dept pages
+and attachment pdfs. Pages are made from crawler/fixtures/: a curriculum
+lists 40 * --scale courses numbered after the requested semester and
+cou_code, and every course has a syllabus, --attachment-rate of them with
+an attachment.
+
+Sessions behave like CCXP's: each form page opens one with its own
+ACIXSTORE and captcha, posts with the wrong auth_num get "Wrong check
+code", and once a session is older than --session-ttl seconds or used for
+--session-requests pages, it gets the short "session interrupted" page.
+Data pages and attachments can be slowed down (--latency, --jitter) and
+fail at random with 503 (--error-rate) or an empty body (--empty-rate).
+
+--write-config writes a copy of the config pointing at the simulator, with
+the response cache off, for the crawler to use:
+
+    NTHU_COURSE_CONFIG=simulator.cfg python crawl_course.py
+    NTHU_COURSE_CONFIG=simulator.cfg python -m crawler.decaptcha --benchmark 50
+
+Captchas are drawn with Pillow, or taken from --captcha-corpus, a directory
+of labelled captchas (e.g. 123.png) so the recognisers can be measured.
+'''
+
+import configparser
+import io
+import os
+import random
+import re
+import string
+import threading
+import time
+import zlib
+from collections import Counter
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+try:
+    from urllib.parse import parse_qs, unquote, urlsplit
+except ImportError:
+    from urlparse import parse_qs, unquote, urlsplit
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+from config import cou_codes
+from utils.config import (
+    CONFIG_ENV, ROOT_DIR, config_path, get_config_section
+)
+
+FIXTURES = os.path.join(ROOT_DIR, 'crawler', 'fixtures')
+ENCODING = 'cp950'
+LIVE_URL = 'https://www.ccxp.nthu.edu.tw'
+
+# course numbers on the fixture pages, replaced by the requested ones
+CURRICULUM_NO = re.compile(r'10510EE  (\d{4})00')
+SYLLABUS_NO = '10510EE  200100'
+ATTACHMENT_SYLLABUS_NO = '10510CS  340400'
+
+INTERRUPTED_PAGE = (
+    '<html><body>Sorry, your session is interrupted! '
+    'Please login again.</body></html>'
+)
+WRONG_CODE_PAGE = '<html><body>Wrong check code!</body></html>'
+OK_PAGE = '<html><body><font class="title">查詢結果</font></body></html>'
+FORM_PAGE = '''<html>
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=big5">
+</head>
+<body>
+<form name="form1" method="post" action="{action}">
+<input type="hidden" name="ACIXSTORE" value="{acixstore}">
+<img src="{captcha}?ACIXSTORE={acixstore}">
+<input type="text" name="auth_num" size="3">
+<select name="{select}">
+{options}
+</select>
+<input type="submit" name="Submit" value="查詢">
+</form>
+</body>
+</html>
+'''
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def path_of(url):
+    return urlsplit(url).path
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read().decode(ENCODING)
+
+
+def corpus_captchas(path):
+    '''
+    [(image bytes, label)] of the labelled captchas in directory path, see
+    crawler.decaptcha.labelled_samples
+    '''
+    captchas = []
+    for filename in sorted(os.listdir(path)):
+        label = os.path.splitext(filename)[0].split('_')[0]
+        if label.isdigit():
+            with open(os.path.join(path, filename), 'rb') as f:
+                captchas.append((f.read(), label))
+    return captchas
+
+
+def draw_captcha(digits):
+    '''
+    png of dark digits on white, apart enough to be cut at blank columns
+    '''
+    image = Image.new('L', (16 * len(digits) + 8, 24), 255)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for i, digit in enumerate(digits):
+        draw.text((6 + 16 * i, 6), digit, fill=0, font=font)
+    fp = io.BytesIO()
+    image.save(fp, 'png')
+    return fp.getvalue()
+
+
+class Session(object):
+    def __init__(self, captcha, image=None):
+        self.captcha = captcha
+        self.image = image
+        self.created = time.time()
+        self.pages = 0
+
+
+class Simulator(object):
+    '''
+    local http server answering like CCXP, see the module docstring
+
+    Use it as a context manager or start() / stop() it; .url is where it
+    listens, .urls the configured urls moved there and .stats counts what
+    was served. new_ticket() opens a session without a form page and
+    returns its (acixstore, auth_num), for crawls that should not depend on
+    captcha recognition.
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0, jitter=0.5,
+                 error_rate=0, empty_rate=0, session_ttl=None,
+                 session_requests=None, scale=1, attachment_rate=0.2,
+                 attachment_size=1 << 18, captcha_corpus=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.session_ttl = session_ttl
+        self.session_requests = session_requests
+        self.scale = scale
+        self.attachment_rate = attachment_rate
+        self.attachment_size = attachment_size
+        self.stats = Counter()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.started = formatdate(time.time(), usegmt=True)
+
+        self.corpus = corpus_captchas(captcha_corpus) if captcha_corpus else []
+        if not self.corpus and Image is None:
+            raise ImportError('Pillow or a captcha corpus is required')
+
+        crawler_config = get_config_section('crawler')
+        captcha_url = get_config_section('decaptcha')['captcha_url_base']
+        self.captcha_path = path_of(captcha_url)
+        self.attachment_prefix = path_of(crawler_config['attachment_url'] % '')
+        self.attachment_prefix = self.attachment_prefix[:-len('.pdf')]
+        self.routes = {
+            path_of(crawler_config['form_url']): self.course_form,
+            path_of(crawler_config['dept_form_url']): self.dept_form,
+            self.captcha_path: self.captcha,
+            path_of(crawler_config['form_action_url']): self.curriculum,
+            path_of(crawler_config['syllabus_url']): self.syllabus,
+            path_of(crawler_config['dept_url']): self.dept,
+        }
+        self.course_action = path_of(crawler_config['form_action_url'])
+        self.dept_action = path_of(crawler_config['dept_url'])
+
+        self.load_fixtures()
+
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                simulator.handle(self, {})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('ascii', 'replace')
+                simulator.handle(self, parse_qs(body))
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.url = 'http://%s:%d' % self.httpd.server_address[:2]
+        self.urls = dict(
+            (name, self.url + path_of(url))
+            for name, url in crawler_config.items() if name.endswith('_url')
+        )
+        self.urls['captcha_url_base'] = self.url + self.captcha_path
+
+    def load_fixtures(self):
+        curriculum = read_fixture('curriculum.html')
+        start = curriculum.index('<tr class="class3">')
+        end = curriculum.index('</table>')
+        self.curriculum_head = curriculum[:start]
+        self.curriculum_rows = curriculum[start:end]
+        self.curriculum_tail = curriculum[end:]
+        self.syllabus_page = read_fixture('syllabus.html')
+        self.attachment_syllabus_page = read_fixture(
+            'syllabus_attachment.html')
+        self.dept_page = read_fixture('dept.html').encode(ENCODING)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    # sessions
+
+    def new_ticket(self):
+        '''
+        open a session, returns (acixstore, the captcha answer)
+        '''
+        with self.lock:
+            if self.corpus:
+                image, captcha = self.random.choice(self.corpus)
+            else:
+                image, captcha = None, '%03d' % self.random.randrange(1000)
+            acixstore = ''.join(self.random.choice(
+                string.ascii_lowercase + string.digits) for _ in range(26))
+            self.sessions[acixstore] = Session(captcha, image)
+            self.stats['sessions'] += 1
+        return acixstore, captcha
+
+    def session(self, acixstore, use=True):
+        '''
+        the live session of acixstore, None if there is none (any more)
+        '''
+        with self.lock:
+            session = self.sessions.get(acixstore)
+            if session is None:
+                return None
+            if use:
+                session.pages += 1
+            if (
+                self.session_ttl is not None and
+                time.time() - session.created > self.session_ttl
+            ) or (
+                self.session_requests is not None and
+                session.pages > self.session_requests
+            ):
+                del self.sessions[acixstore]
+                self.stats['sessions_expired'] += 1
+                return None
+            return session
+
+    # endpoints, each returns (status, body bytes, headers)
+
+    def form(self, action, select, options):
+        acixstore, _ = self.new_ticket()
+        page = FORM_PAGE.format(
+            action=action,
+            acixstore=acixstore,
+            captcha=self.captcha_path,
+            select=select,
+            options='\n'.join(
+                '<option value="%s">%s</option>' % (option, option)
+                for option in options)
+        )
+        return 200, page.encode(ENCODING), {}
+
+    def course_form(self, query):
+        return self.form(self.course_action, 'cou_code', cou_codes)
+
+    def dept_form(self, query):
+        return self.form(self.dept_action, 'DEPT', cou_codes)
+
+    def captcha(self, query):
+        session = self.session(first(query, 'ACIXSTORE'), use=False)
+        if session is None:
+            return 200, INTERRUPTED_PAGE.encode(ENCODING), {}
+        if session.image is None:
+            session.image = draw_captcha(session.captcha)
+        return 200, session.image, {'Content-Type': 'image/png'}
+
+    def check_ticket(self, query):
+        '''
+        the page to answer instead of data, None if the ticket is fine
+        '''
+        session = self.session(first(query, 'ACIXSTORE'))
+        if session is None:
+            return INTERRUPTED_PAGE
+        if session.captcha != first(query, 'auth_num'):
+            self.count('wrong_captcha')
+            return WRONG_CODE_PAGE
+        return None
+
+    def curriculum(self, query):
+        page = self.check_ticket(query)
+        if page is None and 'cou_code' not in query:
+            # captcha validation, see Entrance.validate_by_post
+            page = OK_PAGE
+        if page is not None:
+            return 200, page.encode(ENCODING), {}
+        prefix = (first(query, 'YS').replace('|', '') +
+                  first(query, 'cou_code').strip().ljust(4))
+        rows = [
+            CURRICULUM_NO.sub(
+                lambda match: '%s%s%02d' % (prefix, match.group(1), section),
+                self.curriculum_rows)
+            for section in range(self.scale)
+        ]
+        page = self.curriculum_head + ''.join(rows) + self.curriculum_tail
+        return 200, page.encode(ENCODING), {}
+
+    def syllabus(self, query):
+        if self.session(first(query, 'ACIXSTORE')) is None:
+            return 200, INTERRUPTED_PAGE.encode(ENCODING), {}
+        no = first(query, 'c_key')
+        if self.has_attachment(no):
+            page = self.attachment_syllabus_page.replace(
+                ATTACHMENT_SYLLABUS_NO, no)
+        else:
+            page = self.syllabus_page.replace(SYLLABUS_NO, no)
+        return 200, page.encode(ENCODING), {}
+
+    def has_attachment(self, no):
+        # the same courses every run
+        return zlib.crc32(no.encode('utf-8')) % 1000 < \
+            self.attachment_rate * 1000
+
+    def dept(self, query):
+        page = self.check_ticket(query)
+        if page is None and 'DEPT' not in query:
+            page = OK_PAGE
+        if page is not None:
+            return 200, page.encode(ENCODING), {}
+        return 200, self.dept_page, {}
+
+    def attachment(self, path, headers):
+        no = unquote(path[len(self.attachment_prefix):-len('.pdf')])
+        etag = '"%08x"' % zlib.crc32(no.encode('utf-8'))
+        validators = {'ETag': etag, 'Last-Modified': self.started}
+        if headers.get('If-None-Match') == etag:
+            self.count('not_modified')
+            return 304, b'', validators
+        head = ('%%PDF-1.4\n%% syllabus of %s\n' % no).encode('utf-8')
+        body = head + b'.' * max(0, self.attachment_size - len(head))
+        validators['Content-Type'] = 'application/pdf'
+        return 200, body, validators
+
+    # serving
+
+    def route(self, path):
+        '''
+        (name, endpoint) for a request path, endpoint None if not found
+        '''
+        if path in self.routes:
+            endpoint = self.routes[path]
+            return endpoint.__name__, endpoint
+        if path.startswith(self.attachment_prefix) and path.endswith('.pdf'):
+            return 'attachment', None
+        return 'not_found', None
+
+    def fault(self):
+        '''
+        None, or the status and body of an injected failure
+        '''
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.error_rate:
+            self.count('errors')
+            return 503, b'Service Unavailable'
+        if roll < self.error_rate + self.empty_rate:
+            self.count('empty')
+            return 200, b''
+        return None
+
+    def delay(self):
+        if self.latency:
+            with self.lock:
+                spread = self.random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0, self.latency * (1 + spread)))
+
+    def handle(self, handler, data):
+        url = urlsplit(handler.path)
+        query = parse_qs(url.query)
+        query.update(data)
+        name, endpoint = self.route(url.path)
+        self.count(name)
+
+        headers = {}
+        fault = None
+        if name in ('curriculum', 'syllabus', 'dept', 'attachment'):
+            self.delay()
+            fault = self.fault()
+        if fault is not None:
+            status, body = fault
+        elif name == 'attachment':
+            status, body, headers = self.attachment(url.path, handler.headers)
+        elif endpoint is not None:
+            status, body, headers = endpoint(query)
+        else:
+            status, body = 404, b'Not Found'
+
+        handler.send_response(status)
+        headers.setdefault('Content-Type', 'text/html; charset=big5')
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def write_config(self, filename):
+        '''
+        write a copy of the selected config with every CCXP url moved to the
+        simulator and the response cache off, see utils.config.config_path
+        '''
+        config = configparser.RawConfigParser()
+        config.optionxform = str
+        config.read(config_path())
+        for section in config.sections():
+            for key, value in config.items(section):
+                config.set(section, key, value.replace(LIVE_URL, self.url))
+        config.set('cache', 'path', '')
+        config.set('checkpoint', 'path', 'checkpoints/simulator')
+        with open(config_path(filename), 'w') as f:
+            config.write(f)
+        return config_path(filename)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def report(self):
+        return ', '.join(
+            '%s: %d' % item for item in sorted(self.stats.items()))
+
+
+def first(query, key):
+    return query.get(key, [''])[0]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Serve a local stand-in for CCXP'
+    )
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument(
+        '--latency',
+        help='mean seconds to answer a data page or attachment',
+        default=0,
+        type=float
+    )
+    parser.add_argument(
+        '--jitter',
+        help='latency varies by up to this fraction either way',
+        default=0.5,
+        type=float
+    )
+    parser.add_argument(
+        '--error-rate',
+        help='share of data pages answered with 503',
+        default=0,
+        type=float
+    )
+    parser.add_argument(
+        '--empty-rate',
+        help='share of data pages answered with an empty body',
+        default=0,
+        type=float
+    )
+    parser.add_argument(
+        '--session-ttl',
+        help='seconds a session lives',
+        default=None,
+        type=float
+    )
+    parser.add_argument(
+        '--session-requests',
+        help='pages a session may be used for',
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        '--scale',
+        help='a curriculum lists 40 * SCALE courses (at most 100)',
+        default=1,
+        type=int
+    )
+    parser.add_argument(
+        '--attachment-rate',
+        help='share of syllabi with an attachment',
+        default=0.2,
+        type=float
+    )
+    parser.add_argument(
+        '--attachment-size',
+        help='bytes of every attachment',
+        default=1 << 18,
+        type=int
+    )
+    parser.add_argument(
+        '--captcha-corpus',
+        help='serve these labelled captchas (e.g. 123.png) instead of drawn '
+             'ones',
+        default=None
+    )
+    parser.add_argument('--seed', default=None, type=int)
+    parser.add_argument(
+        '--write-config',
+        help='write a config using the simulator to this file under config/',
+        metavar='FILENAME',
+        default=None
+    )
+    args = parser.parse_args()
+
+    if not 1 <= args.scale <= 100:
+        parser.error('--scale must be between 1 and 100')
+
+    simulator = Simulator(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        empty_rate=args.empty_rate,
+        session_ttl=args.session_ttl,
+        session_requests=args.session_requests,
+        scale=args.scale,
+        attachment_rate=args.attachment_rate,
+        attachment_size=args.attachment_size,
+        captcha_corpus=args.captcha_corpus,
+        seed=args.seed
+    )
+    if args.write_config:
+        print('config written to %s' % simulator.write_config(
+            args.write_config))
+        print('use it with %s=%s' % (CONFIG_ENV, args.write_config))
+    print('serving CCXP on %s' % simulator.url)
+    try:
+        simulator.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.httpd.server_close()
+        print(simulator.report())
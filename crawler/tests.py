@@ -0,0 +1,1251 @@
+import contextlib
+import csv
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+import lxml.html
+import numpy
+import requests
+from PIL import Image
+
+import analyse_keywords
+import config as cfg
+import crawler.course
+from crawler.attachment import AttachmentDownloader, download, meta_path
+from crawler.cache import ResponseCache, TTLPolicy
+from crawler.checkpoint import Checkpoint
+from crawler.decaptcha import (
+    DecaptchaFailure, FallbackRecogniser, Recogniser, TemplateRecogniser,
+    TicketPool, benchmark_offline, binarize, binarize_batch,
+    build_recogniser, denoise, gray_array, labelled_samples,
+    print_offline_benchmark, segment
+)
+import crawler.decaptcha
+import crawler.crawler
+from crawler.crawler import (
+    CourseNoIndex, CourseWriter, CrawlReport, dept_from_html,
+    save_syllabus_dict
+)
+from crawler.course import SessionExpired, Ticket, WrongCheckCode
+from crawler.engine import CrawlEngine, Request
+from crawler.extract import ExtractionError, TextExtractor, file_digest
+from crawler.keywords import KeywordMatcher
+from crawler.ratelimit import (
+    AIMDController, Backoff, get_controller, host_slot, metrics)
+from crawler.scheduler import Scheduler
+from crawler.simulator import Simulator, draw_captcha
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+    '''
+    local http server answering every path with the path itself, or with a
+    short session interrupted page for ACIXSTOREs in <expired>
+    '''
+
+    def __init__(self, delay=0.05, failures=0, expired=()):
+        self.delay = delay
+        self.failures = failures
+        self.expired = set(expired)
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                time.sleep(server.delay)
+                body = self.path.encode('ascii')
+                query = parse_qs(urlsplit(self.path).query)
+                if set(query.get('ACIXSTORE', ())) & server.expired:
+                    body = b'session interrupted'
+                with server.lock:
+                    status = 503 if server.failures else 200
+                    server.failures = max(0, server.failures - 1)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with server.lock:
+                    server.active -= 1
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class CrawlEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.response_cache = crawler.course.response_cache
+        crawler.course.response_cache = None
+
+    def tearDown(self):
+        crawler.course.response_cache = self.response_cache
+
+    def test_every_response_is_handled(self):
+        handled = []
+        with StandInServer(delay=0) as server:
+            count = CrawlEngine(host_concurrency=4).crawl(
+                [Request('get', '%s/%d' % (server.url, i), context=i)
+                 for i in range(20)],
+                lambda response, request: handled.append(
+                    (response.text, request.context))
+            )
+        self.assertEqual(count, 20)
+        self.assertEqual(
+            sorted(handled, key=lambda x: x[1]),
+            [('/%d' % i, i) for i in range(20)]
+        )
+
+    def test_handler_can_schedule_more_requests(self):
+        handled = []
+
+        def handler(response, request):
+            handled.append(response.text)
+            if request.context == 'page':
+                return [
+                    Request('get', '%s/item/%d' % (server.url, i),
+                            context='item')
+                    for i in range(3)
+                ]
+
+        with StandInServer(delay=0) as server:
+            count = CrawlEngine().crawl(
+                [Request('get', server.url + '/page', context='page')],
+                handler
+            )
+        self.assertEqual(count, 4)
+        self.assertEqual(handled[0], '/page')
+        self.assertEqual(
+            sorted(handled[1:]), ['/item/0', '/item/1', '/item/2'])
+
+    def test_lazy_requests_are_taken_within_window(self):
+        taken = []
+        handled = []
+        ahead = []
+
+        def requests():
+            for i in range(50):
+                taken.append(i)
+                ahead.append(len(taken) - len(handled))
+                yield Request('get', '%s/%d' % (server.url, i))
+
+        with StandInServer(delay=0.01) as server:
+            count = CrawlEngine(host_concurrency=2, window=5).crawl(
+                requests(),
+                lambda response, request: handled.append(response.text)
+            )
+        self.assertEqual(count, 50)
+        self.assertLessEqual(max(ahead), 5)
+
+    def test_failed_fetches_are_skipped(self):
+        handled = []
+        with StandInServer(delay=0) as server:
+            requests_ = [Request('get', '%s/%d' % (server.url, i))
+                         for i in range(5)]
+            # nothing listens there
+            requests_.insert(2, Request('get', 'http://127.0.0.1:9/',
+                                        max_retries=1))
+            before = metrics.get('fetch_failures', 0)
+            engine = CrawlEngine(host_concurrency=2)
+            count = engine.crawl(
+                requests_,
+                lambda response, request: handled.append(response.text)
+            )
+        self.assertEqual(count, 5)
+        self.assertEqual(engine.failed, 1)
+        self.assertEqual(sorted(handled), ['/%d' % i for i in range(5)])
+        self.assertEqual(metrics['fetch_failures'], before + 1)
+
+    def test_parser_runs_in_worker_processes(self):
+        handled = []
+        with StandInServer(delay=0) as server:
+            CrawlEngine(parse_workers=2).crawl(
+                [Request('get', '%s/%s' % (server.url, 'x' * i), parser=len)
+                 for i in range(5)],
+                lambda result, request: handled.append(result)
+            )
+        self.assertEqual(sorted(handled), [1, 2, 3, 4, 5])
+
+    def test_host_concurrency_is_bounded(self):
+        with StandInServer() as server:
+            CrawlEngine(host_concurrency=3, max_workers=10).crawl(
+                [Request('post', server.url, context=i) for i in range(12)],
+                lambda response, request: None
+            )
+        self.assertEqual(server.max_active, 3)
+
+
+    def test_expired_session_is_renewed_and_replayed(self):
+        handled = []
+        refreshes = []
+
+        def refresh():
+            refreshes.append(1)
+            return 'fresh', '1234'
+
+        ticket = Ticket('stale', '0000', refresh)
+        with StandInServer(delay=0, expired=['stale']) as server:
+            CrawlEngine(host_concurrency=4).crawl(
+                [Request('get', '%s/%d' % (server.url, i), ticket=ticket,
+                         params={'ACIXSTORE': 'stale'})
+                 for i in range(8)],
+                lambda response, request: handled.append(response.text)
+            )
+        self.assertEqual(len(refreshes), 1)
+        self.assertEqual(len(handled), 8)
+        for text in handled:
+            self.assertIn('ACIXSTORE=fresh', text)
+
+    def test_expired_session_without_refresh_fails(self):
+        with StandInServer(delay=0, expired=['stale']) as server:
+            with self.assertRaises(SessionExpired):
+                crawler.course.get(
+                    server.url + '/', params={'ACIXSTORE': 'stale'})
+            ticket = Ticket('stale', '0000')
+            with self.assertRaises(SessionExpired):
+                ticket.renew('stale')
+
+
+class AttachmentServer(StandInServer):
+    '''serves <body> with an ETag, 304 if the client already has it'''
+
+    def __init__(self, body):
+        self.body = body
+        self.etag = '"1"'
+        self.sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == server.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                server.sent += 1
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(server.body)))
+                self.send_header('ETag', server.etag)
+                self.end_headers()
+                self.wfile.write(server.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+
+class AttachmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_unchanged_file_is_kept(self):
+        path = os.path.join(self.path, 'a.pdf')
+        with AttachmentServer(b'%PDF' * 100000) as server:
+            self.assertEqual(download(server.url, path, 1000), 'downloaded')
+            self.assertEqual(download(server.url, path), 'skipped')
+            server.body, server.etag = b'%PDF-2', '"2"'
+            self.assertEqual(download(server.url, path), 'downloaded')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-2')
+        self.assertEqual(server.sent, 2)
+        self.assertEqual(
+            sorted(os.listdir(self.path)), ['a.pdf', 'a.pdf.meta'])
+
+    def test_truncated_file_is_downloaded_again(self):
+        path = os.path.join(self.path, 'a.pdf')
+        with AttachmentServer(b'%PDF' * 10) as server:
+            download(server.url, path)
+            with open(path, 'wb') as f:
+                f.write(b'%PD')
+            self.assertEqual(download(server.url, path), 'downloaded')
+        self.assertEqual(os.path.getsize(path), 40)
+
+    def test_downloads_run_in_background(self):
+        done = []
+        with AttachmentServer(b'%PDF') as server:
+            downloader = AttachmentDownloader(workers=2)
+            for i in range(5):
+                downloader.submit(
+                    server.url, os.path.join(self.path, '%d.pdf' % i),
+                    then=done.append)
+            downloader.submit(
+                server.url, os.path.join(self.path, 'missing', 'x.pdf'))
+            downloader.shutdown()
+        self.assertEqual(len(done), 5)
+        self.assertEqual(downloader.failed, 1)
+        self.assertTrue(os.path.exists(meta_path(done[0])))
+
+    def test_concurrent_downloads_of_one_path(self):
+        path = os.path.join(self.path, 'a.pdf')
+        results = []
+        with StandInServer(delay=0.2) as server:
+            threads = [
+                threading.Thread(target=lambda: results.append(
+                    download(server.url + '/a', path)))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(results, ['downloaded', 'downloaded'])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'/a')
+        self.assertEqual(
+            sorted(os.listdir(self.path)), ['a.pdf', 'a.pdf.meta'])
+
+    def test_path_in_flight_is_downloaded_once(self):
+        path = os.path.join(self.path, 'a.pdf')
+        done = []
+        release = threading.Event()
+        with AttachmentServer(b'%PDF') as server:
+            downloader = AttachmentDownloader(workers=1)
+            # keeps the only worker busy until both are queued
+            downloader.submit(
+                server.url, os.path.join(self.path, 'b.pdf'),
+                then=lambda _: release.wait())
+            first = downloader.submit(server.url, path, then=done.append)
+            second = downloader.submit(server.url, path, then=done.append)
+            release.set()
+            downloader.shutdown()
+        self.assertIs(first, second)
+        self.assertEqual(done, [path, path])
+        self.assertEqual(server.sent, 2)
+        self.assertEqual(downloader.failed, 0)
+
+
+class TextExtractorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.extractor = TextExtractor(
+            workers=1, cache_path=os.path.join(self.path, 'cache'))
+
+    def tearDown(self):
+        self.extractor.shutdown()
+        shutil.rmtree(self.path)
+
+    def write(self, name, content):
+        path = os.path.join(self.path, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_cached_text_is_not_extracted_again(self):
+        path = self.write('a.pdf', b'%PDF-1.4 syllabus')
+        entry = os.path.join(self.path, 'cache', file_digest(path)[:2])
+        os.makedirs(entry)
+        with open(os.path.join(entry, file_digest(path) + '.txt'), 'w') as f:
+            f.write('cached text')
+        self.assertEqual(self.extractor.text(path), 'cached text')
+        self.assertIsNone(self.extractor._executor)
+
+    def test_failures_are_recorded(self):
+        path = self.write('broken.pdf', b'not a pdf')
+        with self.assertRaises(ExtractionError):
+            self.extractor.text(path)
+        self.assertEqual(
+            [failed for failed, _ in self.extractor.failures], [path])
+        digest = file_digest(path)
+        self.assertTrue(os.path.exists(os.path.join(
+            self.path, 'cache', digest[:2], digest + '.error')))
+
+    def test_txt_is_read_directly(self):
+        path = self.write('a.txt', '課程'.encode('utf-8'))
+        self.assertEqual(self.extractor.text(path), '課程')
+
+
+class AnalyseKeywordsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.folder = os.path.join(self.path, '105上')
+        self.cache = os.path.join(self.path, 'cache')
+        os.makedirs(self.folder)
+
+    def write(self, name, content):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def cache_text(self, path, text):
+        digest = file_digest(path)
+        os.makedirs(os.path.join(self.cache, digest[:2]))
+        with open(os.path.join(self.cache, digest[:2], digest + '.txt'),
+                  'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def analyse(self):
+        with ProcessPoolExecutor(
+                2, initializer=analyse_keywords.init_worker,
+                initargs=(False, self.cache)) as executor:
+            done, failures = analyse_keywords.analyse_semester(
+                executor, self.folder, 'log.csv', 1)
+        with open(os.path.join(self.folder, 'log.csv'), newline='') as f:
+            return done, failures, list(csv.reader(f))
+
+    def test_rows_in_file_order(self):
+        txt = '105上-資工-CS239000-計算機.txt'
+        pdf = '105上-電機-EE200000-電路.pdf'
+        broken = '105上-中文-CL100000-文學.pdf'
+        self.write(txt, '全球\n全球global'.encode('utf-8'))
+        self.cache_text(self.write(pdf, b'%PDF-1.4 syllabus'), 'global')
+        self.write(broken, b'not a pdf')
+        self.write('notes.doc', b'')
+        # listed by another department's curriculum than its number's
+        self.write('log.csv', ','.join(
+            ['電資院', '計算機', '', txt] + ['0'] * len(cfg.keywords_list)
+        ).encode('utf-8'))
+
+        done, failures, rows = self.analyse()
+        self.assertEqual(done, 3)
+        self.assertEqual([fName for fName, _ in failures], [broken])
+        self.assertEqual([row[:4] for row in rows], [
+            ['中文', '文學', '', broken],
+            ['電資院', '計算機', '', txt],
+            ['電機', '電路', '', pdf],
+        ])
+        counts = [row[4:-1] for row in rows]
+        self.assertEqual(counts[0], [''] * len(cfg.keywords_list))
+        self.assertEqual(counts[1][:2], ['2', '1'])
+        self.assertEqual(counts[2][:2], ['0', '1'])
+        self.assertTrue(rows[0][-1])
+        self.assertEqual([row[-1] for row in rows[1:]], ['', ''])
+
+
+class KeywordMatcherTest(unittest.TestCase):
+
+    keywords = ['文化', '跨文化', 'culture', 'culture shock', 'aa', '文化']
+    text = ('跨文化 Culture shock, culture shock 多元文化 aaaaa '
+            'cross-culture 文化文化')
+
+    def test_counts_equal_findall(self):
+        import re
+        self.assertEqual(
+            KeywordMatcher(self.keywords).count(self.text),
+            [len(re.findall(k, self.text)) for k in self.keywords]
+        )
+
+    def test_ignore_case(self):
+        import re
+        self.assertEqual(
+            KeywordMatcher(self.keywords, ignore_case=True).count(self.text),
+            [len(re.findall(k, self.text, re.I)) for k in self.keywords]
+        )
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return f.read()
+
+
+def png(gray):
+    fp = io.BytesIO()
+    Image.fromarray(gray.astype(numpy.uint8)).save(fp, 'png')
+    return fp.getvalue()
+
+
+class BinarizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = numpy.random.RandomState(0)
+
+    def test_threshold_matches_pil_point(self):
+        b = png(self.random.randint(0, 256, (24, 60)))
+        # what binarize returned before it worked on arrays: white where
+        # brighter than the threshold
+        old = numpy.asarray(Image.open(io.BytesIO(b)).convert('L').point(
+            lambda c: (c > 150) * 255, '1'))
+        self.assertTrue(numpy.array_equal(gray_array(b) <= 150, ~old))
+        self.assertTrue(numpy.array_equal(binarize(b), denoise(~old)))
+
+    def test_denoise(self):
+        ink = numpy.zeros((5, 6), bool)
+        ink[0, 0] = True  # alone in a corner
+        ink[2, 2] = ink[3, 3] = True  # diagonal neighbours
+        ink[4, 5] = True  # alone on the edge
+        expected = numpy.zeros((5, 6), bool)
+        expected[2, 2] = expected[3, 3] = True
+        self.assertTrue(numpy.array_equal(denoise(ink), expected))
+        self.assertFalse(denoise(numpy.zeros((3, 3), bool)).any())
+
+    def test_denoise_batch_equals_single(self):
+        inks = self.random.rand(4, 10, 12) < 0.2
+        batch = denoise(inks)
+        for ink, denoised in zip(inks, batch):
+            self.assertTrue(numpy.array_equal(denoise(ink), denoised))
+
+    def test_binarize_batch(self):
+        bs = [png(self.random.randint(0, 256, (24, 60))) for _ in range(3)]
+        bs.append(png(self.random.randint(0, 256, (20, 50))))
+        for same_size in (bs[:3], bs):
+            for ink, b in zip(binarize_batch(same_size), same_size):
+                self.assertTrue(numpy.array_equal(ink, binarize(b)))
+        self.assertEqual(binarize_batch([]), [])
+
+    def test_segment(self):
+        ink = numpy.zeros((6, 10), bool)
+        ink[1:4, 1:3] = True
+        ink[2:6, 5:6] = True
+        ink[0:2, 6:8] = True  # touches the previous digit, no blank column
+        digits = segment(ink)
+        self.assertEqual([d.shape for d in digits], [(3, 2), (6, 3)])
+        self.assertEqual(segment(numpy.zeros((6, 10), bool)), [])
+        self.assertEqual(
+            [d.shape for d in segment(numpy.ones((4, 3), bool))], [(4, 3)])
+
+
+def write_captchas(path, labels):
+    for i, label in enumerate(labels):
+        with open(os.path.join(path, '%s_%d.png' % (label, i)), 'wb') as f:
+            f.write(draw_captcha(label))
+
+
+class FixedRecogniser(Recogniser):
+    def __init__(self, result):
+        self.result = result
+
+    def recognise(self, ink):
+        return self.result
+
+
+class RecogniserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        write_captchas(self.path, ['012', '345', '678', '901', '234'])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_labelled_samples(self):
+        open(os.path.join(self.path, 'README'), 'w').close()
+        self.assertEqual(
+            [label for _, label in labelled_samples(self.path)],
+            ['012', '234', '345', '678', '901'])
+
+    def test_template_recogniser(self):
+        recogniser = TemplateRecogniser(labelled_samples(self.path))
+        self.assertEqual(len(recogniser.labels), 15)
+        for label in ('000', '123', '456', '789', '950'):
+            self.assertEqual(
+                recogniser.recognise(binarize(draw_captcha(label))),
+                label.encode('ascii'))
+        self.assertEqual(TemplateRecogniser().recognise(
+            binarize(draw_captcha('123'))), b'')
+
+    def test_benchmark_offline(self):
+        samples = [(draw_captcha(label), label)
+                   for label in ('135', '246', '789')]
+        result = benchmark_offline(
+            samples, TemplateRecogniser(labelled_samples(self.path)))
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['accuracy'], 1.0)
+        with self.assertRaises(ValueError):
+            benchmark_offline([], TemplateRecogniser())
+
+    def test_offline_benchmark_skips_unavailable_recognisers(self):
+        tesseract_error = crawler.decaptcha.tesseract_error
+        crawler.decaptcha.tesseract_error = 'no tesseract'
+        self.addCleanup(
+            setattr, crawler.decaptcha, 'tesseract_error', tesseract_error)
+        for train_corpus, expected in (
+                (None, 'template   skipped: no template corpus'),
+                (self.path, 'template         150   100.00%')):
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                print_offline_benchmark(self.path, train_corpus, None, [150])
+            lines = out.getvalue().splitlines()[1:]
+            self.assertEqual(len(lines), 2)
+            self.assertTrue(lines[0].startswith(expected), lines[0])
+            self.assertEqual(
+                lines[1], 'tesseract  skipped: tesseract >= 3.03 not installed')
+
+    def test_fallback_takes_first_answer_of_length(self):
+        ink = binarize(draw_captcha('123'))
+        self.assertEqual(FallbackRecogniser([
+            FixedRecogniser(b'12'), FixedRecogniser(b'1x3'),
+            FixedRecogniser(b'123'), FixedRecogniser(b'456'),
+        ], length=3).recognise(ink), b'123')
+        self.assertEqual(FallbackRecogniser(
+            [FixedRecogniser(b'12')], length=3).recognise(ink), b'12')
+
+    def test_build_recogniser(self):
+        recogniser = build_recogniser(self.path)
+        self.assertEqual(
+            [type(r) for r in recogniser.recognisers], [TemplateRecogniser])
+        self.assertEqual(
+            recogniser.recognise(binarize(draw_captcha('314'))), b'314')
+        with self.assertRaises(DecaptchaFailure):
+            build_recogniser(None, use_tesseract=False)
+
+
+class TicketPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.captcha_url_base = crawler.decaptcha.captcha_url_base
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        write_captchas(path, ['012', '345', '678', '901', '234'])
+        self.recogniser = TemplateRecogniser(labelled_samples(path))
+        self.simulator = Simulator().start()
+        self.form_url = self.simulator.urls['form_url']
+        self.pools = []
+        crawler.decaptcha.captcha_url_base = \
+            self.simulator.urls['captcha_url_base']
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.shutdown()
+            pool._executor.shutdown(wait=True)
+        crawler.decaptcha.captcha_url_base = self.captcha_url_base
+        self.simulator.stop()
+
+    def pool(self, **kwargs):
+        kwargs.setdefault('recogniser', self.recogniser)
+        pool = TicketPool(workers=2, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_tickets_are_valid_and_topped_up(self):
+        pool = self.pool(size=2)
+        acixstore, captcha = pool.get_ticket(self.form_url)
+        self.assertEqual(
+            self.simulator.sessions[acixstore].captcha.encode('ascii'),
+            captcha)
+        self.wait_for(lambda: pool._tickets[self.form_url].qsize() == 2)
+
+    def test_old_tickets_are_dropped(self):
+        pool = self.pool(size=1, max_age=60)
+        pool._tickets[self.form_url].put(
+            (time.time() - 120, ('stale', b'000')))
+        acixstore, captcha = pool.get_ticket(self.form_url)
+        self.assertNotEqual(acixstore, 'stale')
+        self.assertIn(acixstore, self.simulator.sessions)
+
+    def test_failure_after_retries(self):
+        pool = self.pool(retries=3, recogniser=FixedRecogniser(b'abc'))
+        with self.assertRaises(DecaptchaFailure):
+            pool.get_ticket(self.form_url)
+        self.assertGreaterEqual(self.simulator.stats['course_form'], 3)
+
+    def test_shutdown_wakes_up_get_ticket(self):
+        pool = self.pool(retries=10 ** 6,
+                         recogniser=FixedRecogniser(b'abc'))
+        errors = []
+
+        def get_ticket():
+            try:
+                pool.get_ticket(self.form_url)
+            except DecaptchaFailure as e:
+                errors.append(e)
+
+        waiter = threading.Thread(target=get_ticket)
+        waiter.start()
+        self.wait_for(lambda: self.simulator.stats['course_form'] > 0)
+        pool.shutdown()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(errors), 1)
+        with self.assertRaises(DecaptchaFailure):
+            pool.get_ticket(self.form_url)
+
+
+class CurriculumTest(unittest.TestCase):
+
+    def test_main_rows(self):
+        courses = crawler.course.parse_curriculum(
+            read_fixture('curriculum.html'))
+        self.assertEqual(len(courses), 40)
+        self.assertEqual(courses[0]['no'], '10510EE200000')
+        self.assertEqual(courses[0]['name_en'], 'Electric Circuits')
+        self.assertEqual((courses[0]['size_limit'], courses[0]['fr']),
+                         (120, 10))
+        self.assertTrue(courses[0]['has_prerequisite'])
+
+    def test_chunk_size_does_not_matter(self):
+        html = crawler.course.decode(read_fixture('curriculum.html'))
+        whole = [crawler.course.course_from_tr(tr)
+                 for tr in crawler.course.curriculum_to_trs(html, len(html))]
+        self.assertEqual(
+            [crawler.course.course_from_tr(tr)
+             for tr in crawler.course.curriculum_to_trs(html, 7)],
+            whole
+        )
+
+
+class DeptTest(unittest.TestCase):
+
+    def test_required_courses(self):
+        depts = dept_from_html(
+            crawler.course.decode(read_fixture('dept.html')))
+        self.assertEqual(len(depts), 8)
+        dept_name, cou_nos = depts[0]
+        self.assertEqual(dept_name, 'EE  103BA')
+        self.assertEqual(len(cou_nos), 15)
+        self.assertEqual(cou_nos[0], 'EE    200000')
+
+
+class CourseFromSyllabusTest(unittest.TestCase):
+
+    def test_fields(self):
+        course = crawler.course.parse_syllabus(read_fixture('syllabus.html'))
+        self.assertEqual(course['no'], '10510EE200100')
+        self.assertEqual(course['name_zh'], '電路學')
+        self.assertEqual(course['teacher'], '王小明,陳大文')
+        self.assertEqual(course['room'], '台達館105,台達館106')
+        self.assertIn('第18週', course['syllabus'])
+        self.assertFalse(course['has_attachment'])
+        self.assertEqual(course['attachment_url'], [])
+
+    def test_attachment(self):
+        course = crawler.course.parse_syllabus(
+            read_fixture('syllabus_attachment.html'))
+        self.assertTrue(course['has_attachment'])
+        self.assertEqual(
+            course['attachment_url'],
+            ['ccxp/INQUIRE/JH/output/6_6.1_6.1.12/10510CS  340400.pdf'])
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = ResponseCache(
+            self.path, 1 << 20, TTLPolicy(current_ys='105|20', ttl=60))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def response(self, content):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = 'http://ccxp/'
+        response._content = content
+        return response
+
+    def test_session_tokens_are_not_part_of_the_key(self):
+        self.cache.set('post', 'http://ccxp/', self.response(b'page'),
+                       data={'YS': '105|20', 'ACIXSTORE': 'a', 'auth_num': 1})
+        cached = self.cache.get('post', 'http://ccxp/',
+                                data={'YS': '105|20', 'ACIXSTORE': 'b'})
+        self.assertEqual(cached.content, b'page')
+        self.assertIsNone(
+            self.cache.get('post', 'http://ccxp/', data={'YS': '105|10'}))
+
+    def test_current_semester_expires(self):
+        self.cache.policy.ttl = -1
+        self.cache.set('get', 'http://ccxp/', self.response(b'now'),
+                       params={'c_key': '10520EE  152000'})
+        self.cache.set('get', 'http://ccxp/', self.response(b'old'),
+                       params={'c_key': '10420EE  152000'})
+        self.assertIsNone(self.cache.get(
+            'get', 'http://ccxp/', params={'c_key': '10520EE  152000'}))
+        self.assertEqual(self.cache.get(
+            'get', 'http://ccxp/', params={'c_key': '10420EE  152000'}
+        ).content, b'old')
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for i in range(3):
+            self.cache.set('get', 'http://ccxp/%d' % i,
+                           self.response(b'x' * 1000))
+            os.utime(self.cache._entry_path(
+                self.cache.key('get', 'http://ccxp/%d' % i)), (i, i))
+        self.cache.max_size = self.cache.size() * 1.2
+        self.cache.get('get', 'http://ccxp/0')
+        self.cache.set('get', 'http://ccxp/3', self.response(b'x' * 1000))
+        self.assertIsNotNone(self.cache.get('get', 'http://ccxp/0'))
+        self.assertIsNone(self.cache.get('get', 'http://ccxp/1'))
+        self.assertIsNotNone(self.cache.get('get', 'http://ccxp/3'))
+
+    def test_directory_is_created_on_first_set(self):
+        path = os.path.join(self.path, 'http')
+        cache = ResponseCache(path, 1 << 20, self.cache.policy)
+        self.assertIsNone(cache.get('get', 'http://ccxp/'))
+        self.assertFalse(os.path.exists(path))
+        cache.set('get', 'http://ccxp/', self.response(b'page'))
+        self.assertEqual(cache.get('get', 'http://ccxp/').content, b'page')
+
+    def test_concurrent_sets_keep_the_size(self):
+        self.cache.max_size = 20000
+
+        def fill(n):
+            for i in range(20):
+                self.cache.set('get', 'http://ccxp/%d/%d' % (n, i),
+                               self.response(b'x' * 1000))
+                self.cache.get('get', 'http://ccxp/%d/%d' % (n, i // 2))
+
+        threads = [threading.Thread(target=fill, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        on_disk = sum(size for _, size, _ in self.cache._entries())
+        self.assertEqual(self.cache.size(), on_disk)
+        self.assertLessEqual(on_disk, self.cache.max_size)
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.response_cache = crawler.course.response_cache
+        crawler.course.response_cache = None
+
+    def tearDown(self):
+        crawler.course.response_cache = self.response_cache
+
+    def test_server_errors_are_retried(self):
+        retries = metrics['retries']
+        with StandInServer(delay=0, failures=2) as server:
+            response = crawler.course.get(server.url + '/ok')
+        self.assertEqual(response.text, '/ok')
+        self.assertEqual(metrics['retries'] - retries, 2)
+
+    def test_waiting_for_a_slot_is_not_latency(self):
+        with StandInServer(delay=0) as server:
+            host = urlsplit(server.url).netloc
+            controller = get_controller(host, maximum=1)
+            latencies = []
+            record = controller.record
+            controller.record = lambda latency, ok: latencies.append(latency)
+            self.addCleanup(setattr, controller, 'record', record)
+            held = threading.Event()
+
+            def hold_slot():
+                # a long attachment download
+                with host_slot(host):
+                    held.set()
+                    time.sleep(0.5)
+
+            holder = threading.Thread(target=hold_slot)
+            holder.start()
+            held.wait()
+            start = time.time()
+            crawler.course.get(server.url + '/ok')
+            waited = time.time() - start
+            holder.join()
+        self.assertGreaterEqual(waited, 0.4)
+        self.assertEqual(len(latencies), 1)
+        self.assertLess(latencies[0], 0.3)
+
+    def test_gives_up_after_max_retries(self):
+        with StandInServer(delay=0, failures=5) as server:
+            with self.assertRaises(crawler.course.EmptyResponse):
+                crawler.course.get(server.url, max_retries=2)
+
+
+class RateControlTest(unittest.TestCase):
+
+    def test_backoff_grows_up_to_cap(self):
+        backoff = Backoff(base=1, cap=5)
+        self.assertTrue(all(0 <= backoff.delay(0) <= 1 for i in range(50)))
+        self.assertTrue(all(0 <= backoff.delay(10) <= 5 for i in range(50)))
+
+    def test_aimd_limit(self):
+        controller = AIMDController(8, latency_target=1)
+        controller.record(2, True)
+        self.assertEqual(controller.limit, 4)
+        # a burst of failures only backs off once
+        controller.record(0, False)
+        self.assertEqual(controller.limit, 4)
+        for i in range(30):
+            controller.record(0.1, True)
+        self.assertEqual(controller.limit, 8)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_tasks_can_submit_tasks(self):
+        done = []
+        lock = threading.Lock()
+        active = [0, 0]  # now, max
+
+        def leaf(i):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock:
+                active[0] -= 1
+                done.append(i)
+
+        def branch(n):
+            for i in range(n):
+                scheduler.submit(leaf, i)
+
+        def broken():
+            raise ValueError
+
+        scheduler = Scheduler(workers=3, progress_interval=0)
+        scheduler.submit(branch, 10)
+        scheduler.submit(broken)
+        progress = scheduler.run()
+        self.assertEqual(sorted(done), list(range(10)))
+        self.assertEqual((progress.done, progress.total), (12, 12))
+        self.assertEqual(progress.failed, 1)
+        self.assertLessEqual(active[1], 3)
+
+    def test_requests_and_downloads_share_the_host_limit(self):
+        response_cache = crawler.course.response_cache
+        crawler.course.response_cache = None
+        self.addCleanup(
+            setattr, crawler.course, 'response_cache', response_cache)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with StandInServer(delay=0.05) as server:
+            get_controller(urlsplit(server.url).netloc, maximum=2)
+            downloader = AttachmentDownloader(workers=4)
+
+            def fetch(i):
+                crawler.course.get('%s/page/%d' % (server.url, i))
+                downloader.submit(
+                    '%s/file/%d' % (server.url, i),
+                    os.path.join(directory, '%d.pdf' % i))
+
+            scheduler = Scheduler(workers=8, progress_interval=0)
+            for i in range(8):
+                scheduler.submit(fetch, i)
+            progress = scheduler.run()
+            downloader.shutdown()
+        self.assertEqual(progress.failed, 0)
+        self.assertEqual(len(os.listdir(directory)), 16)  # with .meta files
+        self.assertLessEqual(server.max_active, 2)
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'crawl.journal')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_marks_survive_restart(self):
+        checkpoint = Checkpoint(self.path)
+        checkpoint.mark('curriculum', '105|20', 'EE', value=['10520EE  1'])
+        checkpoint.mark('syllabus', '105|20', '10520EE  1')
+        checkpoint.close()
+        with open(self.path, 'a') as f:
+            f.write('[["syllabus", "105|20", "1052')  # crashed mid-write
+
+        checkpoint = Checkpoint(self.path)
+        self.assertTrue(checkpoint.done('syllabus', '105|20', '10520EE  1'))
+        self.assertFalse(checkpoint.done('syllabus', '105|20', '10520EE  2'))
+        self.assertEqual(
+            checkpoint.get('curriculum', '105|20', 'EE'), ['10520EE  1'])
+        self.assertEqual(checkpoint.keys('curriculum'), [('105|20', 'EE')])
+        checkpoint.mark('syllabus', '105|20', '10520EE  2')
+        checkpoint.close()
+        self.assertTrue(Checkpoint(self.path).done(
+            'syllabus', '105|20', '10520EE  2'))
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+
+class FakeCourse(object):
+    no = '10520EE  152000'
+    syllabus_fingerprint = None
+    saved = 0
+
+    def save(self):
+        self.saved += 1
+
+
+class IncrementalCrawlTest(unittest.TestCase):
+
+    syllabus = {
+        'no': '10520EE  152000', 'name_zh': u'電路', 'name_en': 'Circuits',
+        'credit': '3', 'teacher': u'王', 'time': 'M3M4', 'room': 'EECS',
+        'syllabus': '...', 'has_attachment': False, 'attachment_url': [],
+    }
+
+    def test_unchanged_syllabus_is_not_saved(self):
+        course = FakeCourse()
+        self.assertEqual(
+            save_syllabus_dict(self.syllabus, course, '105|20'), 'changed')
+        self.assertEqual(
+            save_syllabus_dict(self.syllabus, course, '105|20'), 'unchanged')
+        self.assertEqual(course.saved, 1)
+        self.assertEqual(save_syllabus_dict(
+            dict(self.syllabus, syllabus='!'), course, '105|20'), 'changed')
+        self.assertEqual(course.saved, 2)
+
+    def test_report_keeps_most_significant_status(self):
+        report = CrawlReport()
+        report.record('a', 'new')
+        report.record('a', 'unchanged')
+        report.record('b', 'unchanged')
+        report.record('b', 'changed')
+        report.record('c', 'unchanged')
+        self.assertEqual(
+            report.counts(), {'new': 1, 'changed': 1, 'unchanged': 1})
+
+
+class FakeManager(object):
+    def __init__(self, model):
+        self.model = model
+        self.rows = {}
+        self.writes = []
+
+    def in_bulk(self, nos, field_name):
+        return dict((no, self.rows[no]) for no in nos if no in self.rows)
+
+    def bulk_create(self, objs, batch_size):
+        self.writes.append(('create', sorted(c.no for c in objs)))
+        self.rows.update((c.no, c) for c in objs)
+
+    def bulk_update(self, objs, fields, batch_size):
+        self.writes.append(('update', sorted(c.no for c in objs)))
+
+    def filter(self, **kwargs):
+        return self
+
+    def only(self, *fields):
+        return self
+
+    def iterator(self):
+        return iter(self.rows.values())
+
+    def count(self):
+        return len(self.rows)
+
+
+class FakeCourseModel(object):
+    curriculum_fingerprint = None
+    syllabus_fingerprint = None
+
+    def __init__(self, no):
+        self.no = no
+        self.code = ''
+
+
+class FakeCourseModelMixin(object):
+
+    def setUp(self):
+        self.course_model = crawler.crawler.Course
+        crawler.crawler.Course = FakeCourseModel
+        FakeCourseModel.objects = FakeManager(FakeCourseModel)
+
+    def tearDown(self):
+        crawler.crawler.Course = self.course_model
+
+
+def curriculum_row(no):
+    return {
+        'no': no, 'size_limit': 30, 'note': '', 'object': '',
+        'has_prerequisite': False, 'ge_hint': None,
+    }
+
+
+class CourseWriterTest(FakeCourseModelMixin, unittest.TestCase):
+
+    def test_rows_are_written_in_batches(self):
+        writer = CourseWriter(batch_size=3)
+        writer.add_class_info(curriculum_row('A'), 'EE')
+        writer.add_class_info(curriculum_row('B'), 'EE')
+        writer.add_class_info(curriculum_row('A'), 'EECS')
+        writer.add_class_info(curriculum_row('B'), 'EE')
+        writer.add_syllabus('B', IncrementalCrawlTest.syllabus, '105|20')
+        writer.flush()
+        objects = FakeCourseModel.objects
+        self.assertEqual(objects.rows['A'].code, ' EE EECS')
+        self.assertEqual(objects.rows['B'].code, ' EE')
+        self.assertEqual(objects.rows['B'].chi_title, u'電路')
+        self.assertEqual(objects.writes, [
+            ('create', ['A', 'B']), ('update', []),
+            ('create', []), ('update', ['B']),
+        ])
+        self.assertEqual(
+            writer.report.counts(), {'new': 2, 'changed': 0, 'unchanged': 0})
+
+
+class FakeSearchConnection(object):
+    def __init__(self):
+        self.updates = []
+
+    def get_unified_index(self):
+        return self
+
+    def get_index(self, model):
+        return 'CourseIndex'
+
+    def get_backend(self):
+        return self
+
+    def update(self, index, objs):
+        self.updates.append((index, sorted(c.no for c in objs)))
+
+
+class SearchIndexTest(FakeCourseModelMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(SearchIndexTest, self).setUp()
+        self.search_connections = crawler.crawler.search_connections
+        self.connection = FakeSearchConnection()
+        crawler.crawler.search_connections = {'default': self.connection}
+
+    def tearDown(self):
+        super(SearchIndexTest, self).tearDown()
+        crawler.crawler.search_connections = self.search_connections
+
+    def test_only_written_courses_are_indexed(self):
+        row = curriculum_row
+        writer = CourseWriter(batch_size=10)
+        writer.add_class_info(row('A'), 'EE')
+        writer.add_class_info(row('B'), 'EE')
+        writer.flush()
+        writer.add_class_info(row('A'), 'EE')
+        writer.add_class_info(dict(row('B'), note='!'), 'EE')
+        writer.flush()
+        writer.add_class_info(row('A'), 'EE')
+        writer.flush()
+        self.assertEqual(self.connection.updates, [
+            ('CourseIndex', ['A', 'B']), ('CourseIndex', ['B']),
+        ])
+
+
+class CourseNoIndexTest(FakeCourseModelMixin, unittest.TestCase):
+
+    def test_dept_page_numbers_are_found(self):
+        for no in ('10520EE  152000', '10520GE  100100'):
+            FakeCourseModel.objects.rows[no] = FakeCourseModel(no)
+        index = CourseNoIndex('105|20')
+        self.assertEqual(index.get('EE  152000').no, '10520EE  152000')
+        self.assertEqual(index.get('GE 100100').no, '10520GE  100100')
+        self.assertEqual(index.get('10520EE  152000').no, '10520EE  152000')
+        self.assertIsNone(index.get('EE  152001'))
+
+
+class SimulatorTest(FakeCourseModelMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(SimulatorTest, self).setUp()
+        self.response_cache = crawler.course.response_cache
+        crawler.course.response_cache = None
+
+    def tearDown(self):
+        super(SimulatorTest, self).tearDown()
+        crawler.course.response_cache = self.response_cache
+
+    def test_captcha_session(self):
+        with Simulator(session_requests=2) as simulator:
+            response = requests.get(simulator.urls['form_url'])
+            document = lxml.html.fromstring(
+                response.content, base_url=response.url)
+            acixstore = document.xpath('//input[@name="ACIXSTORE"]')[0].value
+            self.assertEqual(
+                document.xpath('//form')[0].action,
+                simulator.urls['form_action_url'])
+            captcha = requests.get(
+                simulator.urls['captcha_url_base'],
+                params={'ACIXSTORE': acixstore})
+            self.assertEqual(captcha.headers['Content-Type'], 'image/png')
+
+            def validate(auth_num):
+                return requests.post(
+                    simulator.urls['form_action_url'],
+                    data={'ACIXSTORE': acixstore, 'auth_num': auth_num})
+
+            self.assertIn(b'Wrong check code', validate('x').content)
+            answer = simulator.sessions[acixstore].captcha
+            self.assertFalse(
+                crawler.course.is_session_expired(validate(answer)))
+            self.assertTrue(
+                crawler.course.is_session_expired(validate(answer)))
+
+    def test_wrong_check_code_is_not_cached(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        crawler.course.response_cache = ResponseCache(
+            path, 1 << 20, TTLPolicy(current_ys='105|20'))
+        with Simulator() as simulator:
+            acixstore, auth_num = simulator.new_ticket()
+            data = {'ACIXSTORE': acixstore, 'YS': '104|20', 'cond': 'a',
+                    'cou_code': 'EE', 'auth_num': 'bad'}
+            with self.assertRaises(WrongCheckCode):
+                crawler.course.post(simulator.urls['form_action_url'],
+                                    data=data)
+            self.assertEqual(crawler.course.response_cache.size(), 0)
+            response = crawler.course.post(
+                simulator.urls['form_action_url'],
+                data=dict(data, auth_num=auth_num))
+        self.assertEqual(
+            len(crawler.course.parse_curriculum(response.content)), 40)
+
+    def test_crawl_course_offline(self):
+        refreshes = []
+
+        def refresh():
+            refreshes.append(1)
+            return simulator.new_ticket()
+
+        with Simulator(error_rate=0.05, empty_rate=0.05,
+                       session_requests=30, seed=1) as simulator:
+            crawler.crawler.form_action_url = \
+                simulator.urls['form_action_url']
+            crawler.crawler.syllabus_url = simulator.urls['syllabus_url']
+            try:
+                report = crawler.crawler.crawl_course(
+                    *simulator.new_ticket(), cou_codes=['EE', 'CS'],
+                    ys='105|20', parse_workers=0, refresh_ticket=refresh)
+            finally:
+                crawler.crawler.form_action_url = \
+                    crawler.course.form_action_url
+                crawler.crawler.syllabus_url = crawler.course.syllabus_url
+        rows = FakeCourseModel.objects.rows
+        self.assertEqual(report.counts()['new'], 80)
+        self.assertEqual(len(rows), 80)
+        self.assertEqual(rows['10520CS239000'].code, ' CS')
+        for course in rows.values():
+            self.assertEqual(course.ys, '105|20')
+        self.assertGreater(len(refreshes), 0)
+        self.assertGreater(simulator.stats['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
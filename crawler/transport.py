@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import threading
+try:
+    from http import cookiejar
+except ImportError:
+    import cookielib as cookiejar
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.config import get_config_section
+
+transport_config = get_config_section('transport')
+
+POOL_SIZE = int(transport_config.get('pool_size', 16))
+CONNECT_TIMEOUT = float(transport_config.get('connect_timeout', 10))
+READ_TIMEOUT = float(transport_config.get('read_timeout', 60))
+
+
+class BlockAll(cookiejar.CookiePolicy):
+    '''
+    never store or send cookies, CCXP sessions live in ACIXSTORE and every
+    request should stand on its own like a bare requests.get
+    '''
+    return_ok = set_ok = domain_return_ok = path_return_ok = \
+        lambda self, *args, **kwargs: False
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+
+class Session(requests.Session):
+    '''
+    requests.Session with a default timeout and a connection pool of
+    <pool_size> keep-alive connections per host
+    '''
+    def __init__(self, pool_size=None, timeout=None):
+        super(Session, self).__init__()
+        self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.cookies.set_policy(BlockAll())
+        pool_size = pool_size or POOL_SIZE
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(Session, self).request(method, url, **kwargs)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    '''
+    the Session shared by every crawler module, created on first use
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = Session()
+        return _session
+
+
+def get(url, **kwargs):
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_session().post(url, **kwargs)
@@ -27,6 +27,9 @@ class Course():
     hit = None
     syllabus = None
     has_attachment = None
+    # hashes of the last saved curriculum row / syllabus, see crawler.crawler
+    curriculum_fingerprint = None
+    syllabus_fingerprint = None
 
     def __str__(self):
         return self.no
@@ -6,14 +6,18 @@ import os
 from os.path import join as join
 import sys
 import subprocess
+import threading
 
 from urllib.request import urlopen
-import requests
-from requests_futures.sessions import FuturesSession
 
 from lxml import html, etree
 from crawler.crawler import crawl_course, crawl_dept
-from crawler.course import gen_cou_codes_dict, course_from_syllabus
+from crawler.course import gen_cou_codes_dict, course_from_syllabus, get, post, Ticket
+from crawler.checkpoint import checkpoint_for
+from crawler.scheduler import Scheduler
+from crawler.attachment import AttachmentDownloader
+from crawler.extract import TextExtractor, ExtractionError
+from crawler.keywords import KeywordMatcher
 
 try:
     from crawler.decaptcha import Entrance, DecaptchaFailure
@@ -23,25 +27,9 @@ except ImportError:
 import config as cfg
 import csv 
 import logging
-import textract
-
-def with_retry(request_function):
-    def function(url, max_retries=32, **kwargs):
-        '''
-        get a valid response in <max_retries> retries
-        change encoding before return
-        raises EmptyResponse if not valid
-        '''
-        for r in range(max_retries):
-            response = request_function(url, **kwargs)
-            if response.content:
-                return response
-        raise EmptyResponse(url)
-    function.__name__ = request_function.__name__
-    return function
-
-get = with_retry(requests.get)
-post = with_retry(requests.post)
+
+# counts all of cfg.keywords_list in one scan
+keyword_matcher = KeywordMatcher(cfg.keywords_list, cfg.keywords_ignore_case)
 
 def get_auth_pair(url):
     if Entrance is not None:
@@ -73,9 +61,9 @@ def syllabus_from_curriculum(acixstore, cou_no):
     req.encoding = "cp950"
     return req
 
-def cou_code_2_curriculum(session, acixstore, cou_code, auth_num, ys):
+def cou_code_2_curriculum(acixstore, cou_code, auth_num, ys):
 
-    return  session.post(
+    return  post(
         cfg.course_url['curriculum'],
         data = {
             'ACIXSTORE' : acixstore,
@@ -84,8 +72,10 @@ def cou_code_2_curriculum(session, acixstore, cou_code, auth_num, ys):
             'dept' : cou_code,
             'auth_num': auth_num })
 
-def download_syllabus_file(path, req, cou_dict, filename):
-    
+def download_syllabus_file(path, req, cou_dict, filename, downloader, then=None):
+    """write the syllabus to a txt file, or queue its attachment on the
+    downloader; then(fName) is called once the file is in place"""
+
     fName = ""
 
     if cou_dict['has_attachment']:
@@ -93,12 +83,8 @@ def download_syllabus_file(path, req, cou_dict, filename):
         fName = "".join([filename, ".pdf"])
         full_path = join(path, fName)
         pdf_url = "https://www.ccxp.nthu.edu.tw/" + cou_dict['attachment_url'][0]
-        res = get(pdf_url)
-
-        with open(full_path,"wb") as pdf:
-            pdf.write(res.content)
-
-        print ("Create {0}".format(fName))
+        downloader.submit(pdf_url, full_path,
+                          then=None if then is None else lambda _: then(fName))
 
     else: 
         fName = "".join([filename, ".txt"])
@@ -108,77 +94,137 @@ def download_syllabus_file(path, req, cou_dict, filename):
             txt.write(cou_dict["syllabus"])
 
         print ("Create {0}".format(fName))
+
+        if then is not None:
+            then(fName)
         
     return fName
 
 
-def keywordAnalyser(fname):
-
-    content = str()
+def keywordAnalyser(fname, extractor):
+    """raises ExtractionError if there is no text to count"""
 
+    content = extractor.text(fname)
     if fname.endswith(".txt"):
-        with open(fname, 'r') as f:
-            content = f.read().replace('\n', '')
-    elif fname.endswith(".pdf"):
-        try:
-            text = textract.process(fname)
-        except textract.exceptions.ShellError:
-            text = b''
-        except TypeError:
-            text = b''
-        content = text.decode('utf-8')
-
-    wordfreq = [len(keyword.findall(content)) for keyword in cfg.keywords_regex_compiled]
-    return wordfreq
-
+        content = content.replace('\n', '')
 
-if __name__ == '__main__':
-
-    acixstore, auth_num = get_auth_pair(cfg.course_url['curriculum_entry'])
-
-    with FuturesSession(max_workers=1) as session:
-
-        for year_semester in sorted(cfg.year_semester_dict.keys()):
-
-            folder = join("./syllabus_download", cfg.year_semester_dict[year_semester])
-            if not os.path.exists(folder):
-                os.makedirs(folder)
-
-            log = open( join(folder, "log"), "w")
-            log_csv = open( join(folder, "log.csv"), "w")
+    wordfreq = keyword_matcher.count(content)
+    return wordfreq
 
-            for cou_code in cfg.cou_codes.keys():
 
-                curriculum = cou_code_2_curriculum(session, acixstore, cou_code, auth_num, year_semester) 
-                curriculum_req = curriculum.result()
-                curriculum_req.encoding = "cp950"
-                curriculum_text = html.fromstring(curriculum_req.text, parser=etree.HTMLParser())
+class Semester(object):
+    """output folder, logs and checkpoint of one semester, shared by the
+    scheduler's worker threads"""
+
+    def __init__(self, ys):
+        self.ys = ys
+        self.folder = join("./syllabus_download", cfg.year_semester_dict[ys])
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.checkpoint = checkpoint_for("get_namelist", ys)
+        # keep the logs of an interrupted run
+        mode = "a" if len(self.checkpoint) else "w"
+        self.log = open(join(self.folder, "log"), mode)
+        self.log_csv = open(join(self.folder, "log.csv"), mode)
+        self.lock = threading.Lock()
+
+    def write(self, line, row):
+        with self.lock:
+            print(line, file=self.log)
+            csv.writer(self.log_csv, delimiter=',').writerow(row)
+            self.log_csv.flush()
+
+    def close(self, complete):
+        self.log.close()
+        self.log_csv.close()
+        if complete:
+            self.checkpoint.remove()
+        else:
+            # failed syllabi are crawled again on the next run
+            self.checkpoint.close()
+
+
+def crawl_curriculum(scheduler, ticket, downloader, extractor, semester, cou_code):
+    checkpoint = semester.checkpoint
+    ys = semester.ys
+
+    if checkpoint.done("curriculum", ys, cou_code):
+        # an interrupted run found these, crawl the syllabi it did not finish
+        nos = checkpoint.get("curriculum", ys, cou_code) or []
+    else:
+        curriculum_req = ticket.call(lambda acixstore, auth_num:
+            cou_code_2_curriculum(acixstore, cou_code, auth_num, ys))
+        curriculum_req.encoding = "cp950"
+        curriculum_text = html.fromstring(curriculum_req.text, parser=etree.HTMLParser())
+        nos = [no.text for no in get_course_no_list(curriculum_text)]
 
-                course_no_list   = get_course_no_list(curriculum_text)
-                for no in course_no_list:
+    for no in nos:
 
-                    if no.text in cfg.id_2_pass_list:
-                        print("{0} been passed".format(no.text))
-                        continue
+        if no in cfg.id_2_pass_list:
+            print("{0} been passed".format(no))
+            continue
 
-                    syllabus_req = syllabus_from_curriculum(acixstore, no.text)
-                    cou_dict = course_from_syllabus(syllabus_req.text)
-                    syllabus_file_name = gen_file_name(cfg.year_semester_dict[year_semester], cou_dict)
-                    # print(cfg.cou_codes[re.sub("[0-9]", "", cou_dict['no'].strip())], file=log)
+        # per listing: a course listed by several departments has a log row
+        # under each of them
+        if checkpoint.done("syllabus", ys, cou_code, no):
+            continue
 
-                    fName = download_syllabus_file(folder, syllabus_req, cou_dict, syllabus_file_name )
-                    print("{0:>10} {1:>30} {2:>50}".format(cfg.cou_codes[cou_code], cou_dict['name_zh'], fName), file=log)
+        scheduler.submit(crawl_syllabus, ticket, downloader, extractor, semester, cou_code, no)
 
-                    w = csv.writer(log_csv, delimiter=',')
+    if not checkpoint.done("curriculum", ys, cou_code):
+        checkpoint.mark("curriculum", ys, cou_code, value=nos)
 
-                    keyword_freq_list = keywordAnalyser(join(str(folder),fName))
-                    data = [cfg.cou_codes[cou_code], cou_dict['name_zh'], '', fName] + keyword_freq_list
-                    w.writerow(data)
 
+def crawl_syllabus(ticket, downloader, extractor, semester, cou_code, no):
+    syllabus_req = ticket.call(lambda acixstore, auth_num:
+        syllabus_from_curriculum(acixstore, no))
+    cou_dict = course_from_syllabus(syllabus_req.text)
+    syllabus_file_name = gen_file_name(cfg.year_semester_dict[semester.ys], cou_dict)
 
-            log.close()
-            log_csv.close()
+    def analyse(fName):
+        try:
+            keyword_freq_list = keywordAnalyser(join(str(semester.folder),fName), extractor)
+            error = ''
+        except ExtractionError as e:
+            # also kept in extractor.failures; no counts rather than zeros,
+            # the last column says why
+            keyword_freq_list = [''] * len(cfg.keywords_list)
+            error = e.message
+        semester.write(
+            "{0:>10} {1:>30} {2:>50}{3}".format(cfg.cou_codes[cou_code], cou_dict['name_zh'], fName,
+                                                " (no text: {0})".format(error) if error else ""),
+            [cfg.cou_codes[cou_code], cou_dict['name_zh'], '', fName] + keyword_freq_list + [error])
+        semester.checkpoint.mark("syllabus", semester.ys, cou_code, no)
+
+    download_syllabus_file(semester.folder, syllabus_req, cou_dict, syllabus_file_name,
+                           downloader, then=analyse)
 
-    
 
+if __name__ == '__main__':
 
+    entry_url = cfg.course_url['curriculum_entry']
+    acixstore, auth_num = get_auth_pair(entry_url)
+    # renewed with a new captcha when CCXP ends the session
+    ticket = Ticket(acixstore, auth_num, lambda: get_auth_pair(entry_url))
+
+    # every semester and department at once, the curriculum tasks queue
+    # their syllabi as they are found
+    scheduler = Scheduler()
+    # attachments stream to disk on threads of their own
+    downloader = AttachmentDownloader()
+    # pdf text is extracted in worker processes and cached by content hash
+    extractor = TextExtractor()
+    semesters = [Semester(ys) for ys in sorted(cfg.year_semester_dict.keys())]
+    for semester in semesters:
+        for cou_code in cfg.cou_codes.keys():
+            scheduler.submit(crawl_curriculum, scheduler, ticket, downloader, extractor, semester, cou_code)
+
+    progress = scheduler.run()
+    downloader.shutdown()
+    extractor.shutdown()
+
+    for path, message in extractor.failures:
+        print("Cannot extract text from {0}: {1}".format(path, message))
+
+    for semester in semesters:
+        semester.close(complete=not (progress.failed or downloader.failed))
@@ -3,12 +3,23 @@ import os
 
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),".."))
 
-def get_config(section, option, filename='nthu_course.cfg'):
+# set NTHU_COURSE_CONFIG to read another file under config/ (or an absolute
+# path) instead, e.g. the one written by python -m crawler.simulator
+CONFIG_ENV = 'NTHU_COURSE_CONFIG'
+
+
+def config_path(filename=None):
+    '''Return the path of a config file, the selected one by default'''
+    filename = filename or os.environ.get(CONFIG_ENV) or 'nthu_course.cfg'
+    return os.path.join(ROOT_DIR, 'config', filename)
+
+
+def get_config(section, option, filename=None):
     '''Return a config in that section'''
     try:
         config = configparser.ConfigParser()
         config.optionxform = str
-        config.read(ROOT_DIR+ '/config/' + filename)
+        config.read(config_path(filename))
         return config.get(section, option)
 
     except Exception as ex:
@@ -16,12 +27,12 @@ def get_config(section, option, filename='nthu_course.cfg'):
         return None
 
 
-def get_config_section(section, filename='nthu_course.cfg'):
+def get_config_section(section, filename=None):
     '''Return all config in that section'''
     try:
         config = configparser.ConfigParser()
         config.optionxform = str
-        config.read(ROOT_DIR+ '/config/' + filename)
+        config.read(config_path(filename))
         return dict(config.items(section))
     except Exception as ex:
         # no config found